@@ -7,9 +7,18 @@ import json
 import time
 import asyncio
 import logging
+import functools
+import threading
+import collections.abc
+import concurrent.futures
+from collections import deque
+from pathlib import Path
 from typing import Dict, List, Any, Optional, Tuple
 
+import aiofiles
+import orjson
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from alive_progress import alive_bar
 
 from utils.api_client import APIClient
@@ -18,58 +27,47 @@ from utils.article_generator import ArticleGenerator
 from utils.image_generator import ImageGenerator
 from utils.file_manager import FileManager
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# セッション状態の初期値
+# 呼び出し可能な値（クラスや関数）はセッションごとに新しいオブジェクトを作るファクトリとして扱う
+_DEFAULTS: Dict[str, Any] = {
+    'api_client': None,
+    'outline_generator': None,
+    'openai_api_key': "",
+    'file_manager': FileManager,
+    'session_dirs': None,
+    'outline': None,
+    'article_sections': list,
+    'image_paths': list,
+    'combined_markdown': None,
+    'zip_path': None,
+    'is_generating': False,
+    'current_step': None,
+    'step_progress': 0.0,
+    'step_message': "",
+    # 最大100件までログを保持（古いものから自動的に破棄）
+    'log_messages': functools.partial(deque, maxlen=100),
+    # リアルタイム表示用の変数
+    'current_generating_section': None,
+    'current_section_content': "",
+    'generated_sections': dict,
+    'generated_images': dict,
+    # バックグラウンドで実行中の生成タスク
+    'generation_future': None,
+}
+
 # Initialize session state variables
 def init_session_state():
-    """初期セッション状態を設定"""
-    if 'api_client' not in st.session_state:
-        st.session_state.api_client = None
-    if 'openai_api_key' not in st.session_state:
-        st.session_state.openai_api_key = ""
-    if 'file_manager' not in st.session_state:
-        st.session_state.file_manager = FileManager()
-    if 'session_dir' not in st.session_state:
-        st.session_state.session_dir = None
-    if 'outline' not in st.session_state:
-        st.session_state.outline = None
-    if 'article_sections' not in st.session_state:
-        st.session_state.article_sections = []
-    if 'image_paths' not in st.session_state:
-        st.session_state.image_paths = []
-    if 'combined_markdown' not in st.session_state:
-        st.session_state.combined_markdown = None
-    if 'zip_path' not in st.session_state:
-        st.session_state.zip_path = None
-    if 'is_generating' not in st.session_state:
-        st.session_state.is_generating = False
-    if 'current_step' not in st.session_state:
-        st.session_state.current_step = None
-    if 'step_progress' not in st.session_state:
-        st.session_state.step_progress = 0.0
-    if 'step_message' not in st.session_state:
-        st.session_state.step_message = ""
-    if 'log_messages' not in st.session_state:
-        st.session_state.log_messages = []
-    # リアルタイム表示用の変数
-    if 'current_generating_section' not in st.session_state:
-        st.session_state.current_generating_section = None
-    if 'current_section_content' not in st.session_state:
-        st.session_state.current_section_content = ""
-    if 'generated_sections' not in st.session_state:
-        st.session_state.generated_sections = {}
-    if 'generated_images' not in st.session_state:
-        st.session_state.generated_images = {}
+    """初期セッション状態を設定（未設定のキーだけを補う）"""
+    for key in _DEFAULTS.keys() - st.session_state.keys():
+        default = _DEFAULTS[key]
+        st.session_state[key] = default() if callable(default) else default
 
 def add_log(message: str):
     """ログメッセージを追加"""
-    timestamp = time.strftime("%H:%M:%S")
-    st.session_state.log_messages.append(f"[{timestamp}] {message}")
-    # 最大100件までログを保持
-    if len(st.session_state.log_messages) > 100:
-        st.session_state.log_messages = st.session_state.log_messages[-100:]
+    # 時刻の整形はログタブの表示時にだけ行う
+    st.session_state.log_messages.append((time.time(), message))
 
 def update_progress(progress: float, message: str):
     """進捗状況を更新"""
@@ -106,6 +104,41 @@ def update_generating_image(section_index: int, heading: str, image_path: str =
         st.session_state.generated_images[section_index] = (heading, image_path)
         add_log(f"セクション {section_index + 1}: {heading} の画像生成完了")
 
+@st.cache_data(show_spinner=False)
+def render_outline_markdown(outline_json: str) -> str:
+    """
+    アウトラインをひとつのMarkdown文字列に変換（アウトライン内容ごとにキャッシュ）
+    
+    Args:
+        outline_json: キャッシュキーを兼ねるアウトラインのJSON文字列
+        
+    Returns:
+        アウトライン表示用のMarkdown
+    """
+    outline = json.loads(outline_json)
+    blocks = []
+    for i, section in enumerate(outline['outline']):
+        blocks.append(f"### {i+1}. {section['heading']}")
+        blocks.append("\n".join(f"- {subheading}" for subheading in section['subheadings']))
+    return "\n\n".join(blocks)
+
+@st.cache_resource(show_spinner=False, max_entries=4)
+def get_zip_bytes(zip_path: str, mtime: float) -> bytes:
+    """
+    ZIPファイルの内容を読み込む（パスと更新時刻ごとにキャッシュし、再実行ごとの読み込みを防ぐ）
+    
+    st.cache_dataは呼び出しごとに値を複製するため、同じbytesオブジェクトを
+    そのまま返すst.cache_resourceを使う
+    
+    Args:
+        zip_path: ZIPファイルのパス
+        mtime: ファイルの更新時刻（キャッシュキー用）
+        
+    Returns:
+        ZIPファイルのバイト列
+    """
+    return Path(zip_path).read_bytes()
+
 async def generate_content(keyword: str, target_audience: str, image_style: str, num_main_headings: int = 30, num_sub_headings: int = 2):
     """
     コンテンツ生成のメインプロセス
@@ -115,11 +148,34 @@ async def generate_content(keyword: str, target_audience: str, image_style: str,
         target_audience: 想定読者
         image_style: 画像スタイル (natural/vivid)
     """
+    # 進捗イベントはキューに溜め、0.5秒ごとに最新の1件だけを画面に反映する
+    progress_queue: asyncio.Queue = asyncio.Queue()
+    
+    def flush_progress():
+        latest = None
+        while not progress_queue.empty():
+            latest = progress_queue.get_nowait()
+        if latest:
+            update_progress(*latest)
+    
+    async def drain_progress():
+        while True:
+            await asyncio.sleep(0.5)
+            flush_progress()
+    
+    drainer = asyncio.create_task(drain_progress())
+    warmup_task = None
+    
     try:
-        # セッションディレクトリを作成
-        if not st.session_state.session_dir:
-            st.session_state.session_dir = st.session_state.file_manager.create_session_dir()
-            add_log(f"セッションディレクトリを作成: {st.session_state.session_dir}")
+        # セッションディレクトリを作成（出力先のサブディレクトリもここで一度だけ作成され、各生成処理側では作成しない）
+        # 古いセッションとして削除済みの場合のみ作り直す
+        if not st.session_state.session_dirs or not os.path.isdir(st.session_state.session_dirs.root):
+            st.session_state.session_dirs = st.session_state.file_manager.create_session_dir()
+            add_log(f"セッションディレクトリを作成: {st.session_state.session_dirs.root}")
+        
+        session_dir = st.session_state.session_dirs.root
+        article_dir = st.session_state.session_dirs.articles
+        image_dir = st.session_state.session_dirs.images
         
         # APIクライアントを初期化
         if not st.session_state.api_client:
@@ -136,12 +192,18 @@ async def generate_content(keyword: str, target_audience: str, image_style: str,
             )
             add_log("APIクライアントを初期化しました")
         
+        # アウトライン生成器はセッション内で使い回す（同じ条件のアウトラインはキャッシュから返る）
+        if not st.session_state.outline_generator:
+            st.session_state.outline_generator = OutlineGenerator(st.session_state.api_client)
+        
+        # アウトライン生成と並行してAPIへの接続（TLS/HTTP2）を確立しておく
+        warmup_task = asyncio.create_task(st.session_state.api_client.warmup())
+        
         # ステップ①: アウトライン生成
         st.session_state.current_step = "outline"
         update_progress(0.1, "アウトライン生成を開始")
         
-        outline_generator = OutlineGenerator(st.session_state.api_client)
-        st.session_state.outline = await outline_generator.generate_outline(
+        st.session_state.outline = await st.session_state.outline_generator.generate_outline(
             keyword=keyword,
             target_audience=target_audience,
             image_style=image_style,
@@ -150,9 +212,9 @@ async def generate_content(keyword: str, target_audience: str, image_style: str,
         )
         
         # アウトラインをファイルに保存
-        outline_path = os.path.join(st.session_state.session_dir, "outline.json")
-        with open(outline_path, 'w', encoding='utf-8') as f:
-            json.dump(st.session_state.outline, f, ensure_ascii=False, indent=2)
+        outline_path = os.path.join(session_dir, "outline.json")
+        async with aiofiles.open(outline_path, 'wb') as f:
+            await f.write(orjson.dumps(st.session_state.outline, option=orjson.OPT_INDENT_2))
             
         update_progress(0.2, "アウトライン生成完了")
         
@@ -165,19 +227,19 @@ async def generate_content(keyword: str, target_audience: str, image_style: str,
             outline=st.session_state.outline,
             keyword=keyword,
             target_audience=target_audience,
-            progress_callback=lambda prog, msg: update_progress(0.2 + prog * 0.4, msg)
+            progress_callback=lambda prog, msg: progress_queue.put_nowait((0.2 + prog * 0.4, msg))
         )
+        flush_progress()
         
         # 生成されたセクションを保存
         st.session_state.article_sections = sections
-        article_dir = os.path.join(st.session_state.session_dir, "articles")
         article_files = await article_generator.save_sections_to_files(sections, article_dir)
         
         # 記事をマークダウンとして結合
-        combined_content = article_generator.combine_sections(sections)
-        combined_path = os.path.join(st.session_state.session_dir, "article_combined.md")
-        with open(combined_path, 'w', encoding='utf-8') as f:
-            f.write(combined_content)
+        combined_content = await asyncio.to_thread(article_generator.combine_sections, sections)
+        combined_path = os.path.join(session_dir, "article_combined.md")
+        async with aiofiles.open(combined_path, 'w', encoding='utf-8') as f:
+            await f.write(combined_content)
             
         st.session_state.combined_markdown = combined_content
         update_progress(0.6, "記事生成完了")
@@ -190,7 +252,6 @@ async def generate_content(keyword: str, target_audience: str, image_style: str,
         headings = [section['heading'] for section in st.session_state.outline['outline']]
         
         image_generator = ImageGenerator(st.session_state.api_client, max_concurrent=10)
-        image_dir = os.path.join(st.session_state.session_dir, "images")
         
         # 各セクションに対して画像を生成
         image_results = await image_generator.generate_all_images(
@@ -198,8 +259,9 @@ async def generate_content(keyword: str, target_audience: str, image_style: str,
             headings=headings,
             image_style=image_style,
             output_dir=image_dir,
-            progress_callback=lambda prog, msg: update_progress(0.6 + prog * 0.3, msg)
+            progress_callback=lambda prog, msg: progress_queue.put_nowait((0.6 + prog * 0.3, msg))
         )
+        flush_progress()
         
         # 画像パスを保存
         st.session_state.image_paths = image_results
@@ -208,31 +270,29 @@ async def generate_content(keyword: str, target_audience: str, image_style: str,
         st.session_state.current_step = "combine"
         update_progress(0.9, "記事と画像を結合")
         
-        # 相対パスで画像を参照するように結合
-        markdown_with_images = image_generator.insert_images_into_markdown(
-            combined_markdown=st.session_state.combined_markdown,
+        # 相対パスで画像を参照するように、セクション単位でファイルへ直接書き出す
+        combined_path = os.path.join(session_dir, "article_with_images.md")
+        await image_generator.write_markdown_with_images(
+            sections=sections,
             image_paths=image_results,
+            output_path=combined_path,
             base_path="images/"
         )
         
-        # 結合したマークダウンを保存
-        combined_path = os.path.join(st.session_state.session_dir, "article_with_images.md")
-        with open(combined_path, 'w', encoding='utf-8') as f:
-            f.write(markdown_with_images)
-            
-        st.session_state.combined_markdown = markdown_with_images
+        # プレビュー用に書き出した内容を読み込む
+        async with aiofiles.open(combined_path, 'r', encoding='utf-8') as f:
+            st.session_state.combined_markdown = await f.read()
         
         # ステップ⑤: ZIPアーカイブを作成
         st.session_state.current_step = "package"
         update_progress(0.95, "ダウンロードパッケージを作成")
         
-        # 記事ファイルと画像ファイルのパスリスト
-        article_files = [os.path.join(article_dir, f) for f in os.listdir(article_dir) if f.endswith('.md')]
-        image_files = [os.path.join(image_dir, f) for f in os.listdir(image_dir) if f.endswith(('.png', '.jpg'))]
+        # 記事ファイルと画像ファイルのパスリスト（保存時の結果をそのまま使用）
+        image_files = [image_path for _, image_path in image_results if image_path]
         
         # ZIPを作成
-        zip_path = st.session_state.file_manager.create_zip_archive(
-            session_dir=st.session_state.session_dir,
+        zip_path = await st.session_state.file_manager.create_zip_archive(
+            session_dir=session_dir,
             article_files=article_files,
             image_files=image_files,
             combined_markdown_path=combined_path
@@ -244,7 +304,7 @@ async def generate_content(keyword: str, target_audience: str, image_style: str,
         st.session_state.file_manager.clean_old_sessions(hours=24)
         
         # 現在のセッションの自動クリーンアップをスケジュール
-        await st.session_state.file_manager.schedule_cleanup(st.session_state.session_dir, hours=24)
+        await st.session_state.file_manager.schedule_cleanup(session_dir, hours=24)
         
         update_progress(1.0, "生成完了！ダウンロードが利用可能です")
         
@@ -253,15 +313,67 @@ async def generate_content(keyword: str, target_audience: str, image_style: str,
         add_log(f"エラー: {str(e)}")
         st.error(f"エラーが発生しました: {str(e)}")
     finally:
+        drainer.cancel()
+        if warmup_task:
+            warmup_task.cancel()
         st.session_state.is_generating = False
 
-def run_async(coroutine):
+class _SessionCoroutine(collections.abc.Coroutine):
+    """
+    コルーチンを包み、再開のたびに元セッションのスクリプト実行コンテキストをスレッドに設定する
+    
+    イベントループは全セッションで共有するため、st.session_stateが実行中タスクの
+    セッションを指すよう、ステップごとにコンテキストを切り替える
+    """
+    def __init__(self, coroutine, ctx):
+        self._coroutine = coroutine
+        self._ctx = ctx
+    
+    def send(self, value):
+        add_script_run_ctx(threading.current_thread(), self._ctx)
+        return self._coroutine.send(value)
+    
+    def throw(self, *args):
+        add_script_run_ctx(threading.current_thread(), self._ctx)
+        return self._coroutine.throw(*args)
+    
+    def close(self):
+        return self._coroutine.close()
+    
+    def __await__(self):
+        return self._coroutine.__await__()
+
+def _session_task_factory(loop, coroutine, **kwargs):
+    """ループ内で作られるタスクに、作成元タスクのセッションを引き継ぐ"""
+    if not isinstance(coroutine, _SessionCoroutine):
+        coroutine = _SessionCoroutine(coroutine, get_script_run_ctx(suppress_warning=True))
+    return asyncio.Task(coroutine, loop=loop, **kwargs)
+
+@st.cache_resource(show_spinner=False)
+def get_event_loop() -> asyncio.AbstractEventLoop:
     """
-    非同期コルーチンを実行するヘルパー関数
+    プロセス全体で共有するバックグラウンドイベントループを取得（初回のみ起動）
+    
+    st.cache_resourceにより再実行やセッションをまたいで同じループとスレッドが
+    使われるため、セッションが増えてもスレッドやループが溜まり続けない
     """
     loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    return loop.run_until_complete(coroutine)
+    loop.set_task_factory(_session_task_factory)
+    thread = threading.Thread(target=loop.run_forever, name="generation-loop", daemon=True)
+    thread.start()
+    return loop
+
+def run_async(coroutine) -> concurrent.futures.Future:
+    """
+    非同期コルーチンをバックグラウンドのイベントループで実行するヘルパー関数
+    
+    Returns:
+        完了状態を確認するためのFuture
+    """
+    # 呼び出し元セッションのコンテキストで実行し、バックグラウンドからもst.session_stateを更新できるようにする
+    return asyncio.run_coroutine_threadsafe(
+        _SessionCoroutine(coroutine, get_script_run_ctx()), get_event_loop()
+    )
 
 def main():
     """メインアプリケーション"""
@@ -361,7 +473,7 @@ def main():
                 st.session_state.is_generating = True
                 # 非同期で生成処理を開始
                 st.info("生成処理を開始します。このプロセスには時間がかかります。")
-                run_async(generate_content(
+                st.session_state.generation_future = run_async(generate_content(
                     keyword=keyword, 
                     target_audience=target_audience, 
                     image_style=image_style,
@@ -369,6 +481,10 @@ def main():
                     num_sub_headings=int(num_sub_headings)
                 ))
 
+    # 生成中かどうかはこの描画の間で一度だけ判定し、重い要素の省略と再実行の判断に共通で使う
+    future = st.session_state.generation_future
+    generating = future is not None and not future.done()
+
     # タブを作成
     tab1, tab2, tab3, tab4 = st.tabs(["進捗状況", "アウトライン", "プレビュー", "ログ"])
 
@@ -415,7 +531,13 @@ def main():
             # 生成済みセクションのリスト表示（折りたたみ式）
             if st.session_state.generated_sections:
                 st.subheader("✅ 生成済みセクション")
-                for idx, (heading, content) in sorted(st.session_state.generated_sections.items()):
+                # 生成スレッドが書き込み中でも安全なようにスナップショットを取ってから表示する
+                generated_sections = sorted(list(st.session_state.generated_sections.items()))
+                if generating:
+                    # 生成中は定期的な再実行のたびに全文と画像を送らないよう、見出しだけを表示する
+                    st.markdown("\n".join(f"- セクション {idx+1}: {heading}" for idx, (heading, _) in generated_sections))
+                    generated_sections = []
+                for idx, (heading, content) in generated_sections:
                     with st.expander(f"セクション {idx+1}: {heading}"):
                         st.markdown(content)
 
@@ -428,28 +550,25 @@ def main():
 
         # 生成完了後、ダウンロードボタンを表示
         if st.session_state.zip_path and os.path.exists(st.session_state.zip_path):
-            with open(st.session_state.zip_path, "rb") as file:
-                st.download_button(
-                    label="記事パッケージをダウンロード",
-                    data=file,
-                    file_name=os.path.basename(st.session_state.zip_path),
-                    mime="application/zip",
-                    help="記事と画像を含むZIPファイルをダウンロード"
-                )
+            zip_path = st.session_state.zip_path
+            st.download_button(
+                label="記事パッケージをダウンロード",
+                data=get_zip_bytes(zip_path, os.path.getmtime(zip_path)),
+                file_name=os.path.basename(zip_path),
+                mime="application/zip",
+                help="記事と画像を含むZIPファイルをダウンロード"
+            )
     
     # タブ2: アウトライン
     with tab2:
         st.subheader("記事アウトライン")
         
-        if st.session_state.outline:
+        if generating:
+            st.info("生成中はアウトラインの表示を省略しています。生成完了後に表示されます。")
+        elif st.session_state.outline:
             # アウトラインを表示
-            for i, section in enumerate(st.session_state.outline['outline']):
-                heading = section['heading']
-                subheadings = section['subheadings']
-                
-                st.markdown(f"### {i+1}. {heading}")
-                for j, subheading in enumerate(subheadings):
-                    st.markdown(f"- {subheading}")
+            outline_json = json.dumps(st.session_state.outline, sort_keys=True, ensure_ascii=False)
+            st.markdown(render_outline_markdown(outline_json))
         else:
             st.info("アウトラインはまだ生成されていません。")
     
@@ -457,7 +576,10 @@ def main():
     with tab3:
         st.subheader("記事プレビュー")
         
-        if st.session_state.combined_markdown:
+        if generating:
+            # 数十万字の本文を再実行のたびに送り直さないよう、生成中は表示しない
+            st.info("生成中はプレビューの表示を省略しています。生成完了後に表示されます。")
+        elif st.session_state.combined_markdown:
             st.markdown(st.session_state.combined_markdown)
         else:
             st.info("プレビューはまだ利用できません。")
@@ -468,8 +590,9 @@ def main():
         
         # ログメッセージを表示
         if st.session_state.log_messages:
-            for message in st.session_state.log_messages:
-                st.text(message)
+            # 生成スレッドからの追加中にdequeを直接反復するとRuntimeErrorになるため、コピーを反復する
+            for logged_at, message in list(st.session_state.log_messages):
+                st.text(f"[{time.strftime('%H:%M:%S', time.localtime(logged_at))}] {message}")
         else:
             st.info("ログはまだありません。")
     
@@ -509,6 +632,14 @@ def main():
             4. 生成完了後、記事パッケージをダウンロード
             """
         )
+    
+    # 生成中は定期的に再実行して進捗を画面に反映
+    # （描画中に完了した場合も、もう一度だけ再実行して省略していた要素を表示する）
+    if generating:
+        time.sleep(1.0)
+        st.rerun()
 
 if __name__ == "__main__":
+    # Configure logging
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     main()
@@ -2,53 +2,205 @@
 API Client for interacting with OpenAI API
 """
 import os
-import json
+import re
+import copy
+import time
+import base64
 import logging
+import functools
 import httpx
 import asyncio
+import orjson
+import tiktoken
+from contextlib import aclosing
 from tenacity import retry, stop_after_attempt, wait_exponential
-from typing import Dict, Any, Optional, List
+from collections import OrderedDict
+from typing import Dict, Any, Optional, List, Tuple, AsyncIterator
+
+from .rate_limiter import TokenBucket
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# モデルごとに読み込み済みのトークナイザーと、読み込み中のタスク
+_encodings: Dict[str, "tiktoken.Encoding"] = {}
+_encoding_loads: Dict[str, "asyncio.Task"] = {}
+# 読み込みに失敗したモデルを再試行するまでの待ち時間（秒）と、次に再試行できる時刻
+_ENCODING_RETRY_INTERVAL = 60.0
+_encoding_retry_at: Dict[str, float] = {}
+
+def _load_encoding(model: str) -> Optional["tiktoken.Encoding"]:
+    """
+    Load the tokenizer for a model (blocking; may download the encoding on first use)
+    
+    Unknown models fall back to o200k_base. Any failure (e.g. the encoding
+    cannot be downloaded) is logged and None is returned, so token counts
+    fall back to an estimate instead of failing the request.
+    """
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logger.warning("Could not load tokenizer for %s, estimating token counts from length: %s", model, e)
+        return None
+
+async def _load_encoding_in_thread(model: str) -> Optional["tiktoken.Encoding"]:
+    """Load the tokenizer in a worker thread and record the outcome"""
+    try:
+        encoding = await asyncio.to_thread(_load_encoding, model)
+        if encoding is not None:
+            _encodings[model] = encoding
+        else:
+            _encoding_retry_at[model] = time.monotonic() + _ENCODING_RETRY_INTERVAL
+        return encoding
+    finally:
+        del _encoding_loads[model]
+
+async def _get_encoding(model: str) -> Optional["tiktoken.Encoding"]:
+    """
+    Get the tokenizer for a model, loading it in a worker thread on first use
+    
+    Concurrent callers share one load. After a failed load, None is returned
+    (and token counts are estimated) until _ENCODING_RETRY_INTERVAL has
+    passed, when the next caller tries again.
+    """
+    encoding = _encodings.get(model)
+    if encoding is not None:
+        return encoding
+    if time.monotonic() < _encoding_retry_at.get(model, 0.0):
+        return None
+    
+    load = _encoding_loads.get(model)
+    if load is None:
+        load = _encoding_loads[model] = asyncio.create_task(_load_encoding_in_thread(model))
+    # 待っている側がキャンセルされても、読み込み自体は他の呼び出し元のために続ける
+    return await asyncio.shield(load)
+
+def _count_tokens(text: str, model: str) -> int:
+    """
+    Count tokens in text for the given model (call after _get_encoding has loaded it)
+    
+    This is only a rate-limit estimate, so it never raises: without a
+    tokenizer it falls back to about 4 characters per token.
+    """
+    encoding = _encodings.get(model)
+    if encoding is None:
+        return len(text) // 4
+    return _count_encoded_tokens(text, encoding)
+
+@functools.lru_cache(maxsize=1024)
+def _count_encoded_tokens(text: str, encoding: "tiktoken.Encoding") -> int:
+    """
+    Count tokens in text with a loaded tokenizer
+    
+    Results are cached by (text, encoding) so repeated system prompts and
+    retries of the same request do not re-encode the text. Estimates made
+    before the tokenizer was loaded are not cached, so they are replaced
+    by real counts once it is available.
+    """
+    try:
+        return len(encoding.encode(text, disallowed_special=()))
+    except Exception as e:
+        logger.warning("Token counting failed, estimating from length: %s", e)
+        return len(text) // 4
+
+# バッチリクエストの応答を各プロンプトに分割するための区切り
+_SECTION_SENTINEL_RE = re.compile(r'^###SECTION (\d+)###[ \t]*$', re.MULTILINE)
+
 class APIClient:
-    def __init__(self, openai_api_key: Optional[str] = None):
+    def __init__(self, openai_api_key: Optional[str] = None,
+                 chat_rpm: int = 500, chat_tpm: int = 90_000, image_rpm: int = 50,
+                 rate_limit_headroom: float = 0.95, image_cache_bytes: int = 8 * 1024 * 1024):
         """
         Initialize API client with OpenAI API key
         
         Args:
             openai_api_key: OpenAI API key (can also be set via OPENAI_API_KEY env var)
+            chat_rpm: Requests per minute allowed for chat completions
+            chat_tpm: Tokens per minute allowed for chat completions
+            image_rpm: Requests per minute allowed for image generation
+            rate_limit_headroom: Fraction of the limits above actually used,
+                leaving a margin for clock skew and other clients of the key
+            image_cache_bytes: Maximum total size of the PNG bytes kept for
+                identical prompts (the client lives as long as the session,
+                so this stays small; 0 disables the cache)
         """
         self.openai_api_key = openai_api_key or os.environ.get("OPENAI_API_KEY")
         
         if not self.openai_api_key:
             logger.warning("OpenAI API key not provided. API calls will fail.")
+        
+        # 全リクエストで使い回すヘッダーとHTTPクライアント（接続をkeep-aliveで再利用）
+        # HTTP/2では1接続上で複数リクエストを多重化できるため、接続数は少数に抑える
+        # クライアントはAPIClient（セッションごとにst.session_stateに保持される）と同じ期間だけ生存し、
+        # 明示的には閉じない（Streamlitにはセッション終了時のフックがないため、セッション破棄時にGCで解放される）
+        self._headers = {
+            "Authorization": f"Bearer {self.openai_api_key}",
+            "Content-Type": "application/json"
+        }
+        self._client = httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(180.0),
+            limits=httpx.Limits(max_connections=4, max_keepalive_connections=4)
+        )
+        
+        # レート制限を超える前に待機するためのトークンバケット（429リトライの削減）
+        # 同時実行数の制御とは独立して、送信レートそのものを上限以下に保つ
+        self._rpm_bucket = TokenBucket.per_minute(chat_rpm * rate_limit_headroom)
+        self._tpm_bucket = TokenBucket.per_minute(chat_tpm * rate_limit_headroom)
+        self._image_bucket = TokenBucket.per_minute(image_rpm * rate_limit_headroom)
+        
+        # 同一プロンプトの画像を再生成しないためのLRUキャッシュ（画像の合計バイト数で上限を設ける）
+        self._image_cache: "OrderedDict[Tuple[str, str, str], Dict[str, Any]]" = OrderedDict()
+        self._image_cache_bytes = image_cache_bytes
+        self._image_cache_used = 0
     
-    @retry(stop=stop_after_attempt(5), wait=wait_exponential(multiplier=1, min=2, max=60))
-    async def call_text_generation_api(self, prompt: str, max_tokens: int = 4000, 
-                           system_prompt: Optional[str] = None, model: str = "gpt-4o",
-                           stream: bool = False, stream_callback = None) -> Dict[Any, Any]:
+    async def warmup(self):
         """
-        Call the OpenAI API for text generation with retry logic for rate limits
+        Open a connection to the OpenAI API and load the tokenizer ahead of the first real request
+        
+        Failures are only logged; the first real request then simply pays the
+        connection setup cost itself.
+        """
+        if not self.openai_api_key:
+            return
+        
+        async def open_connection():
+            try:
+                await self._client.get("https://api.openai.com/v1/models", headers=self._headers)
+            except Exception as e:
+                logger.warning("API warm-up request failed: %s", e)
+        
+        # トークナイザーも接続確立と並行して読み込んでおく
+        await asyncio.gather(open_connection(), _get_encoding("gpt-4o"))
+    
+    async def _prepare_chat_request(self, prompt: str, max_tokens: int,
+                                    system_prompt: Optional[str], model: str,
+                                    stream: bool) -> Dict[str, Any]:
+        """
+        Reserve rate-limit capacity and build the chat completion payload
         
         Args:
             prompt: The user prompt to send to the model
             max_tokens: Maximum tokens in response
             system_prompt: Optional system prompt to guide the model
-            model: OpenAI model to use (default: gpt-4o)
+            model: OpenAI model to use
+            stream: Whether to request a streamed (SSE) response
             
         Returns:
-            Dict containing the API response
+            Request body for the chat completions endpoint
         """
         if not self.openai_api_key:
             raise ValueError("OpenAI API key is required")
-            
-        headers = {
-            "Authorization": f"Bearer {self.openai_api_key}",
-            "Content-Type": "application/json"
-        }
+        
+        # 送信前にRPM/TPMの枠を確保（トークナイザーの初回読み込みはイベントループを塞がないよう別スレッドで行う）
+        await _get_encoding(model)
+        prompt_tokens = _count_tokens(prompt, model)
+        if system_prompt:
+            prompt_tokens += _count_tokens(system_prompt, model)
+        await self._rpm_bucket.acquire(1)
+        await self._tpm_bucket.acquire(max_tokens + prompt_tokens)
         
         messages = []
         
@@ -57,79 +209,206 @@ class APIClient:
             
         messages.append({"role": "user", "content": prompt})
         
-        data = {
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Calling %s (max_tokens=%d, stream=%s, prompt=%d chars)", model, max_tokens, stream, len(prompt))
+        
+        return {
             "model": model,
             "messages": messages,
             "max_tokens": max_tokens,
             "stream": stream
         }
+    
+    @retry(stop=stop_after_attempt(2), wait=wait_exponential(multiplier=1, min=2, max=60))
+    async def call_text_generation_api(self, prompt: str, max_tokens: int = 4000, 
+                           system_prompt: Optional[str] = None, model: str = "gpt-4o",
+                           stream: bool = False, stream_callback = None) -> Dict[Any, Any]:
+        """
+        Call the OpenAI API for text generation with retry logic for rate limits
+        
+        Args:
+            prompt: The user prompt to send to the model
+            max_tokens: Maximum tokens in response
+            system_prompt: Optional system prompt to guide the model
+            model: OpenAI model to use (default: gpt-4o)
+            stream: Receive the response as a stream and assemble it
+            stream_callback: Optional async callback(chunk, full_text) called per chunk
+            
+        Returns:
+            Dict containing the API response
+        """
+        if stream:
+            # ストリーミングモードは逐次版を使って完全なレスポンスを構築
+            collected_content = ""
+            async with aclosing(self.call_text_generation_api_stream(
+                prompt=prompt,
+                max_tokens=max_tokens,
+                system_prompt=system_prompt,
+                model=model
+            )) as deltas:
+                async for content in deltas:
+                    collected_content += content
+                    if stream_callback:
+                        await stream_callback(content, collected_content)
+            
+            return {"choices": [{"message": {"content": collected_content}}]}
+        
+        data = await self._prepare_chat_request(prompt, max_tokens, system_prompt, model, stream=False)
+            
+        try:
+            # 通常モードでAPI呼び出し
+            response = await self._client.post(
+                "https://api.openai.com/v1/chat/completions",
+                headers=self._headers,
+                json=data
+            )
+            response.raise_for_status()
+            return orjson.loads(response.content)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 429:
+                logger.warning("Rate limit exceeded, retrying...")
+                raise
+            logger.error("HTTP error: %s", e)
+            raise
+        except Exception as e:
+            logger.error("Error calling OpenAI API: %s", e)
+            raise
+    
+    async def call_text_generation_api_stream(self, prompt: str, max_tokens: int = 4000,
+                                  system_prompt: Optional[str] = None,
+                                  model: str = "gpt-4o") -> AsyncIterator[str]:
+        """
+        Stream a text generation response from the OpenAI API (SSE)
+        
+        No retry is applied here, since chunks already yielded cannot be
+        taken back; callers that need retries restart the whole stream.
+        
+        Args:
+            prompt: The user prompt to send to the model
+            max_tokens: Maximum tokens in response
+            system_prompt: Optional system prompt to guide the model
+            model: OpenAI model to use (default: gpt-4o)
             
+        Yields:
+            Content deltas as they arrive
+        """
+        data = await self._prepare_chat_request(prompt, max_tokens, system_prompt, model, stream=True)
+        
         try:
-            if stream:
-                # ストリーミングモードでAPI呼び出し
-                async with httpx.AsyncClient(timeout=180.0) as client:
-                    async with client.stream(
-                        "POST",
-                        "https://api.openai.com/v1/chat/completions",
-                        headers=headers,
-                        json=data,
-                        timeout=180.0
-                    ) as response:
-                        response.raise_for_status()
+            async with self._client.stream(
+                "POST",
+                "https://api.openai.com/v1/chat/completions",
+                headers=self._headers,
+                json=data
+            ) as response:
+                response.raise_for_status()
+                
+                # ストリーミングレスポンスを処理
+                async for chunk in response.aiter_lines():
+                    if not chunk.strip():
+                        continue
                         
-                        # 累積レスポンスを格納
-                        full_response = {"choices": [{"message": {"content": ""}}]}
-                        collected_content = ""
+                    if not chunk.startswith("data: "):
+                        continue
                         
-                        # ストリーミングレスポンスを処理
-                        async for chunk in response.aiter_lines():
-                            if not chunk.strip():
-                                continue
-                                
-                            if not chunk.startswith("data: "):
-                                continue
-                                
-                            if chunk.startswith("data: [DONE]"):
-                                break
-                                
-                            # データパートを抽出
-                            json_str = chunk[6:]
-                            try:
-                                chunk_data = json.loads(json_str)
-                                delta = chunk_data.get("choices", [{}])[0].get("delta", {})
-                                content = delta.get("content", "")
-                                
-                                if content:
-                                    collected_content += content
-                                    if stream_callback:
-                                        await stream_callback(content, collected_content)
-                            except Exception as e:
-                                logger.error(f"Error parsing streaming chunk: {e}")
+                    if chunk.startswith("data: [DONE]"):
+                        break
                         
-                        # 完全なレスポンスを構築
-                        full_response["choices"][0]["message"]["content"] = collected_content
-                        return full_response
-            else:
-                # 通常モードでAPI呼び出し
-                async with httpx.AsyncClient(timeout=180.0) as client:
-                    response = await client.post(
-                        "https://api.openai.com/v1/chat/completions",
-                        headers=headers,
-                        json=data
-                    )
-                    response.raise_for_status()
-                    return response.json()
+                    # データパートを抽出
+                    json_str = chunk[6:]
+                    try:
+                        chunk_data = orjson.loads(json_str)
+                        delta = chunk_data.get("choices", [{}])[0].get("delta", {})
+                        content = delta.get("content", "")
+                    except Exception as e:
+                        logger.error("Error parsing streaming chunk: %s", e)
+                        continue
+                    
+                    if content:
+                        yield content
         except httpx.HTTPStatusError as e:
             if e.response.status_code == 429:
-                logger.warning("Rate limit exceeded, retrying...")
+                logger.warning("Rate limit exceeded while streaming")
                 raise
-            logger.error(f"HTTP error: {e}")
+            logger.error("HTTP error: %s", e)
             raise
         except Exception as e:
-            logger.error(f"Error calling OpenAI API: {e}")
+            logger.error("Error streaming from OpenAI API: %s", e)
             raise
     
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=30))
+    async def call_text_generation_api_batch(self, prompts: List[str], max_tokens: int = 4000,
+                                 system_prompt: Optional[str] = None,
+                                 model: str = "gpt-4o") -> List[str]:
+        """
+        Send several prompts in a single chat completion request
+        
+        The prompts are numbered in one user message and the model is asked to
+        answer each of them inside its own ###SECTION k### block, so the shared
+        system prompt is sent (and billed) once per batch instead of per prompt.
+        
+        Args:
+            prompts: List of user prompts to answer
+            max_tokens: Maximum tokens in response (shared by the whole batch)
+            system_prompt: Optional system prompt to guide the model
+            model: OpenAI model to use (default: gpt-4o)
+            
+        Returns:
+            List of response texts in the same order as prompts
+            (empty string for any block missing from the response)
+        """
+        tasks_text = "\n\n".join(
+            f"###SECTION {k}###\n{task}" for k, task in enumerate(prompts, start=1)
+        )
+        batch_prompt = (
+            f"Complete each of the following {len(prompts)} tasks independently.\n"
+            "Start your answer to task k with a line containing only ###SECTION k### "
+            "(for example ###SECTION 1###) and do not write anything before the first marker.\n\n"
+            f"{tasks_text}"
+        )
+        
+        response = await self.call_text_generation_api(
+            prompt=batch_prompt,
+            max_tokens=max_tokens,
+            system_prompt=system_prompt,
+            model=model
+        )
+        
+        choices = response.get('choices', [])
+        if not choices or not isinstance(choices, list):
+            raise ValueError("Invalid response format from OpenAI API")
+        content = choices[0].get('message', {}).get('content', '')
+        if choices[0].get('finish_reason') == 'length':
+            logger.warning("Batch response hit max_tokens=%d; later sections may be incomplete", max_tokens)
+        
+        # [前置き, k1, 本文1, k2, 本文2, ...] に分割して番号で対応付け
+        parts = _SECTION_SENTINEL_RE.split(content)
+        answers = {int(k): text.strip() for k, text in zip(parts[1::2], parts[2::2])}
+        return [answers.get(k, "") for k in range(1, len(prompts) + 1)]
+    
+    def _cache_image(self, cache_key: Tuple[str, str, str], result: Dict[str, Any]):
+        """
+        Store a generated image, evicting the oldest entries to stay within image_cache_bytes
+        
+        Args:
+            cache_key: Normalised (prompt, size, style) key
+            result: Result dict holding the PNG bytes
+        """
+        size = len(result["image_bytes"])
+        if size > self._image_cache_bytes:
+            return
+        
+        # 同じプロンプトが並行して生成された場合は古い方を置き換える
+        previous = self._image_cache.pop(cache_key, None)
+        if previous is not None:
+            self._image_cache_used -= len(previous["image_bytes"])
+        
+        self._image_cache[cache_key] = result
+        self._image_cache_used += size
+        while self._image_cache_used > self._image_cache_bytes:
+            _, evicted = self._image_cache.popitem(last=False)
+            self._image_cache_used -= len(evicted["image_bytes"])
+    
+    @retry(stop=stop_after_attempt(2), wait=wait_exponential(multiplier=1, min=2, max=30))
     async def generate_image(self, prompt: str, size: str = "1024x1024", 
                           style: str = "natural") -> Dict[Any, Any]:
         """
@@ -141,15 +420,21 @@ class APIClient:
             style: Image style (natural or vivid)
             
         Returns:
-            Dict containing image URL and other response data
+            Dict containing the decoded PNG bytes ("image_bytes") and
+            the prompt DALL-E actually used ("revised_prompt")
         """
         if not self.openai_api_key:
             raise ValueError("OpenAI API key is required")
-            
-        headers = {
-            "Authorization": f"Bearer {self.openai_api_key}",
-            "Content-Type": "application/json"
-        }
+        
+        # 同じプロンプト・サイズ・スタイルの画像は生成済みのものを返す
+        cache_key = (" ".join(prompt.split()).lower(), size, style)
+        cached = self._image_cache.get(cache_key)
+        if cached is not None:
+            self._image_cache.move_to_end(cache_key)
+            logger.info("Reusing cached image for identical prompt")
+            return copy.deepcopy(cached)
+        
+        await self._image_bucket.acquire(1)
         
         data = {
             "model": "dall-e-3",
@@ -157,24 +442,39 @@ class APIClient:
             "size": size,
             "style": style,
             "quality": "standard",
+            "response_format": "b64_json",
             "n": 1
         }
             
         try:
-            async with httpx.AsyncClient(timeout=120.0) as client:
-                response = await client.post(
-                    "https://api.openai.com/v1/images/generations",
-                    headers=headers,
-                    json=data
-                )
-                response.raise_for_status()
-                return response.json()
+            response = await self._client.post(
+                "https://api.openai.com/v1/images/generations",
+                headers=self._headers,
+                json=data,
+                timeout=120.0
+            )
+            response.raise_for_status()
+            
+            # 画像はレスポンスに埋め込まれて返るため、URLからの再ダウンロードは不要
+            payload = orjson.loads(response.content)
+            if not payload.get('data'):
+                raise ValueError("Invalid response format from DALL-E API")
+            image_data = payload['data'][0]
+            if not image_data.get('b64_json'):
+                raise ValueError("No image data in DALL-E response")
+            result = {
+                "image_bytes": base64.b64decode(image_data['b64_json']),
+                "revised_prompt": image_data.get('revised_prompt')
+            }
+            
+            self._cache_image(cache_key, result)
+            return copy.deepcopy(result)
         except httpx.HTTPStatusError as e:
             if e.response.status_code == 429:
                 logger.warning("Rate limit exceeded, retrying...")
                 raise
-            logger.error(f"HTTP error: {e}")
+            logger.error("HTTP error: %s", e)
             raise
         except Exception as e:
-            logger.error(f"Error generating image: {e}")
+            logger.error("Error generating image: %s", e)
             raise
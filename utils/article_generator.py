@@ -5,26 +5,191 @@ import os
 import json
 import logging
 import asyncio
+import textwrap
+from contextlib import aclosing
 from typing import Dict, List, Any, Optional, Tuple
 
+from tenacity import AsyncRetrying, stop_after_attempt, wait_exponential
+
 from .api_client import APIClient
+from .rate_limiter import ConcurrencyLimiter
+from .async_writer import AsyncArtifactWriter, artifact_writer
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# 各セクションの末尾に付ける終端マーカー
+_END_MARKER = "<!--END_SECTION-->"
+
+# セクション本文を依頼するユーザープロンプトのテンプレート
+_USER_PROMPT_TEMPLATE = textwrap.dedent("""
+    Write a comprehensive section for an article about "{keyword}" targeting {target_audience}.
+    
+    # Section Heading:
+    {heading}
+    
+    # Subheadings to Cover:
+    {subheadings_text}
+    
+    Please write at least 10,000 words on this topic, covering each subheading thoroughly.
+    Assume the reader has basic familiarity with the topic but wants in-depth knowledge.
+    
+    Use markdown formatting for headings, lists, and emphasis.
+    Start with the main heading (# {heading}) followed by content about the general topic.
+    Then include each subheading (## {first_subheading} etc.) with detailed content for each.
+    
+    Include practical tips, examples, case studies, and research findings where relevant.
+    Make your writing engaging, informative, and valuable for {target_audience}.
+    
+    End your section with a brief summary and add <!--END_SECTION--> at the very end.
+    """).strip()
+
+# バッチリクエストで1セクション分として渡すプロンプトのテンプレート
+# （全セクションが1つの応答に収まるよう、セクションごとの分量を指定する）
+_BATCH_SECTION_PROMPT_TEMPLATE = textwrap.dedent("""
+    Write one section of an article about "{keyword}" targeting {target_audience}.
+    
+    # Section Heading:
+    {heading}
+    
+    # Subheadings to Cover:
+    {subheadings_text}
+    
+    Write about {word_budget} words for this section, covering each subheading.
+    The other sections of this request share the same response, so do not go over this length.
+    
+    Use markdown formatting for headings, lists, and emphasis.
+    Start with the main heading (# {heading}) followed by content about the general topic.
+    Then include each subheading (## {first_subheading} etc.) with detailed content for each.
+    
+    End your section with a brief summary and add <!--END_SECTION--> at the very end.
+    """).strip()
+
+# 1セクションあたりの出力トークン数と、GPT-4oの1リクエストあたりの出力トークン上限
+_SECTION_MAX_TOKENS = 4000
+_MODEL_MAX_OUTPUT_TOKENS = 16384
+# 出力トークン数から目安の単語数を求める係数（見出しやMarkdown記号の分の余裕を含む）
+_WORDS_PER_TOKEN = 0.6
+
 class ArticleGenerator:
-    def __init__(self, api_client: APIClient, max_concurrent: int = 5):
+    # 全セクション共通のシステムプロンプト（バッチリクエストでも共有）
+    _SYSTEM_PROMPT = textwrap.dedent("""
+        You are an expert content writer specializing in comprehensive, high-quality long-form content.
+        Your goal is to write a detailed, thorough, and engaging section of a larger article.
+        Include practical examples, data points, and research where relevant.
+        Create content that would be considered the definitive resource on this topic.
+        """).strip()
+    
+    def __init__(self, api_client: APIClient, max_concurrent: int = 5, batch_size: int = 1,
+                 writer: Optional[AsyncArtifactWriter] = None):
         """
         Initialize article generator
         
         Args:
             api_client: APIClient instance for making API calls
             max_concurrent: Maximum number of concurrent article generation tasks
+            batch_size: Number of sections packed into one API request
+                (1 disables batching and keeps per-section streaming)
+            writer: Background writer for section files (defaults to the shared writer)
         """
         self.api_client = api_client
-        self.max_concurrent = max_concurrent
-        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.batch_size = batch_size
+        self.writer = writer or artifact_writer
+        self._limiter = ConcurrencyLimiter(max_concurrent)
+    
+    @property
+    def max_concurrent(self) -> int:
+        """Current maximum number of concurrent tasks"""
+        return self._limiter.limit
+    
+    async def set_max_concurrent(self, max_concurrent: int):
+        """
+        Change the number of concurrent tasks while generation is running
+        
+        Args:
+            max_concurrent: New maximum number of concurrent tasks
+        """
+        await self._limiter.set_limit(max_concurrent)
+    
+    def _build_user_prompt(self,
+                           heading: str,
+                           subheadings: List[str],
+                           keyword: str,
+                           target_audience: str) -> str:
+        """
+        Build the user prompt for a single section
+        
+        Args:
+            heading: Main heading for this section
+            subheadings: List of subheadings for this section
+            keyword: Main article keyword/topic
+            target_audience: Description of target audience
+            
+        Returns:
+            User prompt text
+        """
+        return _USER_PROMPT_TEMPLATE.format(
+            keyword=keyword,
+            target_audience=target_audience,
+            heading=heading,
+            subheadings_text="\n".join(f"- {sub}" for sub in subheadings),
+            first_subheading=subheadings[0]
+        )
+    
+    def _build_batch_prompt(self,
+                            heading: str,
+                            subheadings: List[str],
+                            keyword: str,
+                            target_audience: str,
+                            max_tokens: int) -> str:
+        """
+        Build the prompt for one section of a batch request
+        
+        Args:
+            heading: Main heading for this section
+            subheadings: List of subheadings for this section
+            keyword: Main article keyword/topic
+            target_audience: Description of target audience
+            max_tokens: Output tokens available to this section
+            
+        Returns:
+            Section prompt text
+        """
+        return _BATCH_SECTION_PROMPT_TEMPLATE.format(
+            keyword=keyword,
+            target_audience=target_audience,
+            heading=heading,
+            subheadings_text="\n".join(f"- {sub}" for sub in subheadings),
+            first_subheading=subheadings[0],
+            word_budget=int(max_tokens * _WORDS_PER_TOKEN)
+        )
+    
+    def _build_error_section(self, heading: str, subheadings: List[str], keyword: str) -> str:
+        """
+        Build a placeholder section used when generation fails
+        
+        Args:
+            heading: Main heading for this section
+            subheadings: List of subheadings for this section
+            keyword: Main article keyword/topic
+            
+        Returns:
+            Placeholder section content
+        """
+        return f"""
+                # {heading}
+                
+                *Content generation for this section encountered an error. This is a placeholder.*
+                
+                ## {subheadings[0] if subheadings else 'Overview'}
+                
+                This section was meant to cover important aspects of {heading} related to {keyword}.
+                
+                ## {subheadings[1] if len(subheadings) > 1 else 'Additional Information'}
+                
+                Further information would have been provided here.
+                
+                <!--END_SECTION-->
+                """
     
     async def generate_section(self, 
                             section_index: int,
@@ -33,8 +198,7 @@ class ArticleGenerator:
                             keyword: str,
                             target_audience: str,
                             section_callback=None,
-                            stream: bool = False,
-                            stream_callback=None) -> Tuple[int, str]:
+                            stream: bool = False) -> Tuple[int, str]:
         """
         Generate a single section of the article
         
@@ -44,80 +208,63 @@ class ArticleGenerator:
             subheadings: List of subheadings for this section
             keyword: Main article keyword/topic
             target_audience: Description of target audience
+            section_callback: Optional async callback(section_index, heading, content, partial=False).
+                When streaming, it receives each delta with partial=True as it arrives,
+                followed by the complete section content
+            stream: Receive the section via SSE streaming
             
         Returns:
             Tuple of (section_index, generated_content)
         """
-        async with self.semaphore:
-            logger.info(f"Generating section {section_index + 1}: {heading}")
-            
-            # Create prompt for Claude API
-            system_prompt = """
-            You are an expert content writer specializing in comprehensive, high-quality long-form content.
-            Your goal is to write a detailed, thorough, and engaging section of a larger article.
-            Include practical examples, data points, and research where relevant.
-            Create content that would be considered the definitive resource on this topic.
-            """
-            
-            subheadings_text = "\n".join([f"- {sub}" for sub in subheadings])
-            
-            user_prompt = f"""
-            Write a comprehensive section for an article about "{keyword}" targeting {target_audience}.
-            
-            # Section Heading:
-            {heading}
-            
-            # Subheadings to Cover:
-            {subheadings_text}
-            
-            Please write at least 10,000 words on this topic, covering each subheading thoroughly.
-            Assume the reader has basic familiarity with the topic but wants in-depth knowledge.
-            
-            Use markdown formatting for headings, lists, and emphasis.
-            Start with the main heading (# {heading}) followed by content about the general topic.
-            Then include each subheading (## {subheadings[0]} etc.) with detailed content for each.
+        async with self._limiter:
+            logger.info("Generating section %d: %s", section_index + 1, heading)
             
-            Include practical tips, examples, case studies, and research findings where relevant.
-            Make your writing engaging, informative, and valuable for {target_audience}.
-            
-            End your section with a brief summary and add <!--END_SECTION--> at the very end.
-            """
+            # Create prompt for OpenAI API
+            system_prompt = self._SYSTEM_PROMPT
+            user_prompt = self._build_user_prompt(heading, subheadings, keyword, target_audience)
             
             try:
-                # セクションの先頭部分は即時表示用に生成
-                section_header = f"# {heading}\n\n"
-                
-                # ストリーミングコールバック関数
-                async def handle_stream_chunk(chunk: str, full_text: str):
-                    # セクションヘッダーを追加
-                    display_content = section_header + full_text
+                if stream:
+                    # 受信したチャンクを逐次コールバックに流しながら本文を組み立てる
+                    # （失敗時はストリーム全体をやり直す）
+                    async for attempt in AsyncRetrying(stop=stop_after_attempt(2),
+                                                       wait=wait_exponential(multiplier=1, min=2, max=60),
+                                                       reraise=True):
+                        with attempt:
+                            buf = []
+                            async with aclosing(self.api_client.call_text_generation_api_stream(
+                                prompt=user_prompt,
+                                system_prompt=system_prompt,
+                                max_tokens=_SECTION_MAX_TOKENS,
+                                model="gpt-4o"
+                            )) as deltas:
+                                async for delta in deltas:
+                                    buf.append(delta)
+                                    if section_callback:
+                                        await section_callback(section_index, heading, delta, partial=True)
                     
-                    if section_callback and stream_callback:
-                        # ストリーミング更新をコールバック
-                        await section_callback(section_index, heading, display_content)
-                
-                # Call OpenAI API to generate the section (with streaming if enabled)
-                response = await self.api_client.call_text_generation_api(
-                    prompt=user_prompt,
-                    system_prompt=system_prompt,
-                    max_tokens=4000,  # GPT-4oの制限内の値（最大4096）
-                    model="gpt-4o",
-                    stream=stream,
-                    stream_callback=handle_stream_chunk if stream else None
-                )
-                
-                # Extract content from response
-                choices = response.get('choices', [])
-                if not choices or not isinstance(choices, list):
-                    raise ValueError("Invalid response format from OpenAI API")
+                    section_content = "".join(buf)
+                else:
+                    # Call OpenAI API to generate the section
+                    response = await self.api_client.call_text_generation_api(
+                        prompt=user_prompt,
+                        system_prompt=system_prompt,
+                        max_tokens=_SECTION_MAX_TOKENS,
+                        model="gpt-4o"
+                    )
                     
-                section_content = choices[0].get('message', {}).get('content', '')
+                    # Extract content from response
+                    choices = response.get('choices', [])
+                    if not choices or not isinstance(choices, list):
+                        raise ValueError("Invalid response format from OpenAI API")
+                        
+                    section_content = choices[0].get('message', {}).get('content', '')
                 
                 # Ensure the section ends with the required marker
-                if "<!--END_SECTION-->" not in section_content:
-                    section_content += "\n\n<!--END_SECTION-->"
+                if _END_MARKER not in section_content:
+                    section_content += f"\n\n{_END_MARKER}"
                 
-                logger.info(f"Successfully generated section {section_index + 1} ({len(section_content)} chars)")
+                logger.info("Successfully generated section %d (%d chars)", section_index + 1, len(section_content))
                 
                 # コールバックがあれば生成完了を通知
                 if section_callback:
@@ -126,24 +273,74 @@ class ArticleGenerator:
                 return section_index, section_content
                 
             except Exception as e:
-                logger.error(f"Error generating section {section_index + 1}: {e}")
+                logger.error("Error generating section %d: %s", section_index + 1, e)
                 # Return a minimal section in case of error
-                error_section = f"""
-                # {heading}
-                
-                *Content generation for this section encountered an error. This is a placeholder.*
-                
-                ## {subheadings[0] if subheadings else 'Overview'}
-                
-                This section was meant to cover important aspects of {heading} related to {keyword}.
-                
-                ## {subheadings[1] if len(subheadings) > 1 else 'Additional Information'}
+                return section_index, self._build_error_section(heading, subheadings, keyword)
+    
+    async def generate_section_batch(self,
+                                  start_index: int,
+                                  sections: List[Dict[str, Any]],
+                                  keyword: str,
+                                  target_audience: str,
+                                  section_callback=None) -> List[Tuple[int, str]]:
+        """
+        Generate several consecutive sections with a single API request
+        
+        The response budget is raised up to the model's output limit and split
+        evenly between the sections, and each section prompt asks for a length
+        that fits its share, so later sections are not cut off.
+        
+        Args:
+            start_index: Section index of the first section in the batch
+            sections: Outline entries (heading and subheadings) for this batch
+            keyword: Main article keyword/topic
+            target_audience: Description of target audience
+            section_callback: Optional callback notified for each finished section
+            
+        Returns:
+            List of tuples (section_index, generated_content)
+        """
+        async with self._limiter:
+            end_index = start_index + len(sections)
+            logger.info("Generating sections %d-%d in one request", start_index + 1, end_index)
+            
+            # 応答全体の上限をモデルの出力上限まで引き上げ、セクション数で等分する
+            max_tokens = min(_SECTION_MAX_TOKENS * len(sections), _MODEL_MAX_OUTPUT_TOKENS)
+            section_tokens = max_tokens // len(sections)
+            prompts = [
+                self._build_batch_prompt(section['heading'], section['subheadings'],
+                                         keyword, target_audience, section_tokens)
+                for section in sections
+            ]
+            
+            try:
+                contents = await self.api_client.call_text_generation_api_batch(
+                    prompts=prompts,
+                    system_prompt=self._SYSTEM_PROMPT,
+                    max_tokens=max_tokens,
+                    model="gpt-4o"
+                )
+            except Exception as e:
+                logger.error("Error generating sections %d-%d: %s", start_index + 1, end_index, e)
+                contents = [""] * len(sections)
+            
+            results = []
+            for offset, (section, section_content) in enumerate(zip(sections, contents)):
+                section_index = start_index + offset
+                heading = section['heading']
                 
-                Further information would have been provided here.
+                if not section_content:
+                    logger.error("Missing content for section %d in batch response", section_index + 1)
+                    section_content = self._build_error_section(heading, section['subheadings'], keyword)
+                elif _END_MARKER not in section_content:
+                    section_content += f"\n\n{_END_MARKER}"
                 
-                <!--END_SECTION-->
-                """
-                return section_index, error_section
+                if section_callback:
+                    await section_callback(section_index, heading, section_content)
+                    
+                results.append((section_index, section_content))
+            
+            return results
     
     async def generate_all_sections(self, 
                              outline: Dict[str, List[Dict[str, Any]]],
@@ -155,6 +352,9 @@ class ArticleGenerator:
         """
         Generate all article sections from the outline
         
+        When batch_size is greater than 1, consecutive sections are grouped and
+        each group is generated with one request (streaming is not used).
+        
         Args:
             outline: Article outline with headings and subheadings
             keyword: Main article keyword/topic
@@ -164,44 +364,63 @@ class ArticleGenerator:
         Returns:
             List of tuples (section_index, section_content) sorted by index
         """
-        logger.info(f"Starting generation of {len(outline['outline'])} article sections")
+        outline_sections = outline['outline']
+        total = len(outline_sections)
+        logger.info("Starting generation of %d article sections", total)
         
-        # Create tasks for all sections
+        # Create tasks for all sections (or batches of sections)
         tasks = []
-        for i, section in enumerate(outline['outline']):
-            heading = section['heading']
-            subheadings = section['subheadings']
-            
-            # Create a task for each section
-            task = asyncio.create_task(
-                self.generate_section(
-                    section_index=i, 
-                    heading=heading, 
-                    subheadings=subheadings, 
-                    keyword=keyword, 
-                    target_audience=target_audience, 
-                    section_callback=section_callback,
-                    stream=stream,  # ストリーミングモードを有効化
-                    stream_callback=True  # ストリーミングコールバック機能を有効化
+        if self.batch_size > 1:
+            for start in range(0, total, self.batch_size):
+                task = asyncio.create_task(
+                    self.generate_section_batch(
+                        start_index=start,
+                        sections=outline_sections[start:start + self.batch_size],
+                        keyword=keyword,
+                        target_audience=target_audience,
+                        section_callback=section_callback
+                    )
                 )
-            )
-            tasks.append(task)
+                tasks.append(task)
+        else:
+            for i, section in enumerate(outline_sections):
+                heading = section['heading']
+                subheadings = section['subheadings']
+                
+                # Create a task for each section
+                task = asyncio.create_task(
+                    self.generate_section(
+                        section_index=i, 
+                        heading=heading, 
+                        subheadings=subheadings, 
+                        keyword=keyword, 
+                        target_audience=target_audience, 
+                        section_callback=section_callback,
+                        stream=stream  # ストリーミングモードを有効化
+                    )
+                )
+                tasks.append(task)
         
         # Process tasks with progress reporting
-        results = []
+        # (section indices are 0..total-1, so each result goes straight into its slot and no sort is needed)
+        results: List[Optional[Tuple[int, str]]] = [None] * total
+        completed_count = 0
         for future in asyncio.as_completed(tasks):
-            section_index, content = await future
-            results.append((section_index, content))
+            completed = await future
+            if self.batch_size <= 1:
+                completed = [completed]
             
-            # Report progress if callback provided
-            if progress_callback:
-                progress = len(results) / len(tasks)
-                progress_callback(progress, f"Generated section {section_index + 1}/{len(tasks)}")
+            for section_index, content in completed:
+                results[section_index] = (section_index, content)
+                completed_count += 1
                 
-            logger.info(f"Completed {len(results)}/{len(tasks)} sections")
+                # Report progress if callback provided
+                if progress_callback:
+                    progress = completed_count / total
+                    progress_callback(progress, f"Generated section {section_index + 1}/{total}")
+                
+            logger.info("Completed %d/%d sections", completed_count, total)
         
-        # Sort results by section index
-        results.sort(key=lambda x: x[0])
         return results
         
     async def save_sections_to_files(self, 
@@ -212,22 +431,19 @@ class ArticleGenerator:
         
         Args:
             sections: List of tuples (section_index, section_content)
-            output_dir: Directory to save files
+            output_dir: Directory to save files (must already exist)
             
         Returns:
             List of saved file paths
         """
-        os.makedirs(output_dir, exist_ok=True)
-        file_paths = []
-        
-        for section_index, content in sections:
-            file_path = os.path.join(output_dir, f"section_{section_index + 1:02d}.md")
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(content)
-            file_paths.append(file_path)
-            logger.info(f"Saved section {section_index + 1} to {file_path}")
-            
-        return file_paths
+        # 書き込みはバックグラウンドの書き込みスレッドに任せ、完了だけを待つ
+        futures = [
+            self.writer.submit(os.path.join(output_dir, f"section_{section_index + 1:02d}.md"), content)
+            for section_index, content in sections
+        ]
+        file_paths = await asyncio.gather(*[asyncio.wrap_future(future) for future in futures])
+        logger.info("Saved %d sections to %s", len(file_paths), output_dir)
+        return list(file_paths)
         
     def combine_sections(self, sections: List[Tuple[int, str]]) -> str:
         """
@@ -242,11 +458,8 @@ class ArticleGenerator:
         # Sort sections by index to ensure correct order
         sorted_sections = sorted(sections, key=lambda x: x[0])
         
-        # Concatenate all section content
-        combined_content = ""
-        for _, content in sorted_sections:
-            # Remove the END_SECTION marker when combining
-            section_content = content.replace("<!--END_SECTION-->", "")
-            combined_content += section_content + "\n\n"
-            
-        return combined_content
+        if not sorted_sections:
+            return ""
+        
+        # Join all section content in one pass, removing the END_SECTION marker
+        return "\n\n".join(content.replace(_END_MARKER, "") for _, content in sorted_sections) + "\n\n"
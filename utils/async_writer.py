@@ -0,0 +1,84 @@
+"""
+Async artifact writer module for buffered background file writes
+"""
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncArtifactWriter:
+    def __init__(self, batch_size: int = 32):
+        """
+        Initialize artifact writer
+
+        Files submitted to the writer are written by a single background
+        thread, so callers never block on disk I/O.
+
+        Args:
+            batch_size: Maximum number of queued files written per batch
+        """
+        self.batch_size = batch_size
+        self._q: "queue.Queue[tuple]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+
+    def submit(self, path: str, content: str) -> Future:
+        """
+        Queue a text file to be written in the background
+
+        Args:
+            path: Path of the file to write
+            content: Text content of the file
+
+        Returns:
+            Future that resolves to the path once the file is written
+        """
+        self._ensure_started()
+        future: Future = Future()
+        self._q.put((path, content, future))
+        return future
+
+    def flush(self):
+        """
+        Block until every queued file has been written (blocking; run via asyncio.to_thread)
+        """
+        if self._thread is not None:
+            self._q.join()
+
+    def _ensure_started(self):
+        # 最初の書き込み要求時（またはスレッドが停止していた場合）にスレッドを起動する
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="artifact-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._q.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._q.get_nowait())
+                except queue.Empty:
+                    break
+
+            for path, content, future in batch:
+                try:
+                    # 呼び出し側でキャンセル済みの書き込みは行わない
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    with open(path, 'w', encoding='utf-8', buffering=1 << 16) as f:
+                        f.write(content)
+                    future.set_result(path)
+                except Exception as e:
+                    logger.error("Error writing %s: %s", path, e)
+                    future.set_exception(e)
+                finally:
+                    self._q.task_done()
+
+
+# アプリ全体（全セッション）で共有する書き込みスレッド
+artifact_writer = AsyncArtifactWriter()
@@ -7,13 +7,19 @@ import logging
 import asyncio
 import zipfile
 import time
-from datetime import datetime, timedelta
+from dataclasses import dataclass
+from datetime import datetime
 from typing import List, Dict, Any, Optional
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+@dataclass(frozen=True)
+class SessionDirs:
+    """Directories of a single generation session (all created up front)"""
+    root: str
+    articles: str
+    images: str
+
 class FileManager:
     def __init__(self, base_dir: str = 'static/temp'):
         """
@@ -24,28 +30,36 @@ class FileManager:
         """
         self.base_dir = base_dir
         os.makedirs(base_dir, exist_ok=True)
+        
+        # Precompute the absolute base_dir prefix used by get_relative_path
+        self._base_prefix = os.path.abspath(base_dir).rstrip(os.sep) + os.sep
+        self._prefix_len = len(self._base_prefix)
     
-    def create_session_dir(self) -> str:
+    def create_session_dir(self) -> SessionDirs:
         """
-        Create a new session directory
+        Create a new session directory with its articles/images subdirectories
         
         Returns:
-            Path to created session directory
+            SessionDirs with the paths of the created directories
         """
         # Create unique directory name using timestamp
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         session_id = f"session_{timestamp}"
         session_dir = os.path.join(self.base_dir, session_id)
+        dirs = SessionDirs(
+            root=session_dir,
+            articles=os.path.join(session_dir, "articles"),
+            images=os.path.join(session_dir, "images")
+        )
         
-        # Create directories
-        os.makedirs(session_dir, exist_ok=True)
-        os.makedirs(os.path.join(session_dir, "articles"), exist_ok=True)
-        os.makedirs(os.path.join(session_dir, "images"), exist_ok=True)
+        # Create directories (makedirs creates the session root along with the first subdirectory)
+        os.makedirs(dirs.articles, exist_ok=True)
+        os.makedirs(dirs.images, exist_ok=True)
         
-        logger.info(f"Created session directory: {session_dir}")
-        return session_dir
+        logger.info("Created session directory: %s", session_dir)
+        return dirs
     
-    def create_zip_archive(self, 
+    async def create_zip_archive(self, 
                         session_dir: str, 
                         article_files: List[str],
                         image_files: List[str],
@@ -53,6 +67,9 @@ class FileManager:
         """
         Create a ZIP archive of the generated content
         
+        The archive is built in a worker thread so the event loop is not
+        blocked while files are read and compressed.
+        
         Args:
             session_dir: Session directory
             article_files: List of article file paths
@@ -67,8 +84,30 @@ class FileManager:
         zip_filename = f"article_package_{timestamp}.zip"
         zip_path = os.path.join(session_dir, zip_filename)
         
-        # Create ZIP file
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        return await asyncio.to_thread(
+            self._build_zip, zip_path, article_files, image_files, combined_markdown_path
+        )
+    
+    def _build_zip(self,
+                   zip_path: str,
+                   article_files: List[str],
+                   image_files: List[str],
+                   combined_markdown_path: Optional[str]) -> str:
+        """
+        Write the ZIP archive (blocking; run via asyncio.to_thread)
+        
+        Args:
+            zip_path: Path of the ZIP file to create
+            article_files: List of article file paths
+            image_files: List of image file paths
+            combined_markdown_path: Path to combined markdown file
+            
+        Returns:
+            Path to the created ZIP file
+        """
+        # Create ZIP file (through a large write buffer to reduce syscalls)
+        with open(zip_path, 'wb', buffering=1 << 20) as raw, \
+                zipfile.ZipFile(raw, 'w', zipfile.ZIP_DEFLATED) as zipf:
             # Add individual article files
             for file_path in article_files:
                 if os.path.exists(file_path):
@@ -79,13 +118,14 @@ class FileManager:
             for file_path in image_files:
                 if os.path.exists(file_path):
                     arcname = os.path.join("images", os.path.basename(file_path))
-                    zipf.write(file_path, arcname)
+                    # PNGは圧縮済みのため再圧縮せずに格納
+                    zipf.write(file_path, arcname, compress_type=zipfile.ZIP_STORED)
             
             # Add combined markdown if provided
             if combined_markdown_path and os.path.exists(combined_markdown_path):
                 zipf.write(combined_markdown_path, "article_combined.md")
                 
-        logger.info(f"Created ZIP archive: {zip_path}")
+        logger.info("Created ZIP archive: %s", zip_path)
         return zip_path
     
     async def schedule_cleanup(self, session_dir: str, hours: int = 24):
@@ -96,59 +136,51 @@ class FileManager:
             session_dir: Path to session directory
             hours: Number of hours after which to delete files
         """
-        logger.info(f"Scheduled cleanup for {session_dir} after {hours} hours")
-        
-        # Write cleanup info file
-        cleanup_info = {
-            "created_at": datetime.now().isoformat(),
-            "cleanup_at": (datetime.now() + timedelta(hours=hours)).isoformat(),
-            "session_dir": session_dir
-        }
+        logger.info("Scheduled cleanup for %s after %d hours", session_dir, hours)
         
-        info_path = os.path.join(session_dir, "cleanup_info.txt")
-        with open(info_path, 'w') as f:
-            for key, value in cleanup_info.items():
-                f.write(f"{key}: {value}\n")
+        # Record the deletion deadline as the directory's access time instead of writing an info file
+        # (mtime is set to now, so the deadline is never earlier than the normal age-based cleanup)
+        now_ts = time.time()
+        cleanup_at_ts = now_ts + hours * 3600
+        os.utime(session_dir, (cleanup_at_ts, now_ts))
         
         # In a production system, we would use a proper task scheduler
         # For this MVP, we'll just log the scheduled time
-        logger.info(f"Temp files in {session_dir} scheduled for deletion at {cleanup_info['cleanup_at']}")
+        logger.info("Temp files in %s scheduled for deletion at %s", session_dir,
+                    datetime.fromtimestamp(cleanup_at_ts).isoformat())
     
     def clean_old_sessions(self, hours: int = 24):
         """
-        Clean up session directories older than specified time
+        Clean up session directories older than specified time (or past their scheduled cleanup)
         
         Args:
             hours: Delete sessions older than this many hours
         """
         try:
-            # Get current time
-            now = datetime.now()
-            cutoff_time = now - timedelta(hours=hours)
+            # Compute the current time and maximum age once
+            now_ts = time.time()
+            max_age = hours * 3600
             
-            # Check all directories in base_dir
-            for session_name in os.listdir(self.base_dir):
-                session_path = os.path.join(self.base_dir, session_name)
-                
-                # Skip if not a directory
-                if not os.path.isdir(session_path):
-                    continue
-                
-                # Check directory creation time
-                try:
-                    # Get directory creation timestamp
-                    creation_time = datetime.fromtimestamp(os.path.getctime(session_path))
+            # Check all directories in base_dir (scandir carries stat info with each entry)
+            with os.scandir(self.base_dir) as entries:
+                for entry in entries:
+                    # Skip if not a directory
+                    if not entry.is_dir(follow_symlinks=False):
+                        continue
                     
-                    # If older than cutoff time, delete it
-                    if creation_time < cutoff_time:
-                        logger.info(f"Cleaning up old session: {session_path}")
-                        shutil.rmtree(session_path, ignore_errors=True)
-                        
-                except Exception as e:
-                    logger.error(f"Error checking/removing session {session_path}: {e}")
+                    try:
+                        # Delete once both the scheduled deadline (st_atime, see schedule_cleanup)
+                        # and the age limit since the last modification have passed
+                        stat = entry.stat(follow_symlinks=False)
+                        if max(stat.st_atime, stat.st_mtime + max_age) < now_ts:
+                            logger.info("Cleaning up old session: %s", entry.path)
+                            shutil.rmtree(entry.path, ignore_errors=True)
+                            
+                    except Exception as e:
+                        logger.error("Error checking/removing session %s: %s", entry.path, e)
         
         except Exception as e:
-            logger.error(f"Error in clean_old_sessions: {e}")
+            logger.error("Error in clean_old_sessions: %s", e)
             
     def get_relative_path(self, file_path: str) -> str:
         """
@@ -160,9 +192,10 @@ class FileManager:
         Returns:
             Relative path suitable for web references
         """
-        # Check if base_dir is in the path
-        if self.base_dir in file_path:
-            return file_path.split(self.base_dir)[-1].lstrip('/')
+        # Strip the base_dir prefix if the file is inside it
+        abs_path = os.path.abspath(file_path)
+        if abs_path.startswith(self._base_prefix):
+            return abs_path[self._prefix_len:]
         
         # Otherwise, just return the filename
         return os.path.basename(file_path)
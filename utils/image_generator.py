@@ -2,20 +2,54 @@
 Image Generator module for creating images for article sections
 """
 import os
+import re
 import logging
 import asyncio
 import aiofiles
-import httpx
-from PIL import Image
-from io import BytesIO
 from typing import Dict, List, Any, Optional, Tuple, Union
 
 from .api_client import APIClient
+from .rate_limiter import ConcurrencyLimiter
+from .article_generator import _END_MARKER
+
+# PNGファイルの先頭8バイト（シグネチャ）
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# 要約用にセクション本文から取り除く要素（HTMLコメント、見出し記号、連続する空行）
+_HTML_COMMENT_RE = re.compile(r'<!--.*?-->', re.DOTALL)
+_HEADING_MARK_RE = re.compile(r'^[ \t]*#+[ \t]*', re.MULTILINE)
+_BLANK_LINES_RE = re.compile(r'\n{3,}')
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+def _png_dimensions(header: bytes) -> Tuple[int, int]:
+    """
+    Read width and height from the first 24 bytes of a PNG file
+    
+    Args:
+        header: Leading bytes of the file (at least 24)
+        
+    Returns:
+        Tuple of (width, height)
+    """
+    if len(header) < 24 or not header.startswith(_PNG_SIGNATURE) or header[12:16] != b"IHDR":
+        raise ValueError("Image data is not a valid PNG")
+    return int.from_bytes(header[16:20], "big"), int.from_bytes(header[20:24], "big")
+
+def _compact_for_summary(text: str) -> str:
+    """
+    Strip markup that carries no visual information before summarizing
+    
+    Args:
+        text: Section content (markdown)
+        
+    Returns:
+        Compacted text
+    """
+    text = _HTML_COMMENT_RE.sub('', text)
+    text = _HEADING_MARK_RE.sub('', text)
+    return _BLANK_LINES_RE.sub('\n\n', text).strip()
+
 class ImageGenerator:
     def __init__(self, api_client: APIClient, max_concurrent: int = 10):
         """
@@ -26,8 +60,21 @@ class ImageGenerator:
             max_concurrent: Maximum number of concurrent image generation tasks
         """
         self.api_client = api_client
-        self.max_concurrent = max_concurrent
-        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self._limiter = ConcurrencyLimiter(max_concurrent)
+    
+    @property
+    def max_concurrent(self) -> int:
+        """Current maximum number of concurrent tasks"""
+        return self._limiter.limit
+    
+    async def set_max_concurrent(self, max_concurrent: int):
+        """
+        Change the number of concurrent tasks while generation is running
+        
+        Args:
+            max_concurrent: New maximum number of concurrent tasks
+        """
+        await self._limiter.set_limit(max_concurrent)
     
     async def generate_section_summary(self, 
                                     section_index: int,
@@ -44,12 +91,13 @@ class ImageGenerator:
         Returns:
             Summary text for image generation
         """
-        logger.info(f"Generating summary for section {section_index + 1}: {heading}")
+        logger.info("Generating summary for section %d: %s", section_index + 1, heading)
         
-        # Truncate section content if too long
-        max_content_length = 8000
-        content_for_summary = section_content[:max_content_length]
-        if len(section_content) > max_content_length:
+        # Compact the content, then truncate it if too long (about 1000 tokens is enough for the summary)
+        max_content_length = 4000
+        compacted_content = _compact_for_summary(section_content)
+        content_for_summary = compacted_content[:max_content_length]
+        if len(compacted_content) > max_content_length:
             content_for_summary += "..."
         
         # Create prompt for OpenAI API
@@ -71,7 +119,7 @@ class ImageGenerator:
         
         try:
             # Call OpenAI API to generate the summary
-            response = await self.api_client.call_openai_api(
+            response = await self.api_client.call_text_generation_api(
                 prompt=prompt,
                 model="gpt-4o",
                 max_tokens=1000
@@ -84,11 +132,11 @@ class ImageGenerator:
                 
             summary = choices[0].get('message', {}).get('content', '')
             
-            logger.info(f"Successfully generated image prompt for section {section_index + 1}")
+            logger.info("Successfully generated image prompt for section %d", section_index + 1)
             return summary
             
         except Exception as e:
-            logger.error(f"Error generating image prompt for section {section_index + 1}: {e}")
+            logger.error("Error generating image prompt for section %d: %s", section_index + 1, e)
             # Return a simple image prompt in case of error
             return f"A detailed conceptual illustration representing {heading} with elements relevant to the topic, featuring professional visual style with clear symbols and meaningful imagery"
     
@@ -97,6 +145,7 @@ class ImageGenerator:
                           heading: str, 
                           image_prompt: str,
                           image_style: str,
+                          image_style_api: str,
                           output_dir: str) -> Tuple[int, str]:
         """
         Generate an image for a section
@@ -105,14 +154,15 @@ class ImageGenerator:
             section_index: Index of the section (for tracking)
             heading: Main heading for this section
             image_prompt: Image generation prompt
-            image_style: Style preference (natural, vivid, etc.)
-            output_dir: Directory to save the generated image
+            image_style: Style preference (natural, vivid, etc.) as written into the prompt
+            image_style_api: DALL-E style parameter already resolved to "natural" or "vivid"
+            output_dir: Directory to save the generated image (must already exist)
             
         Returns:
             Tuple of (section_index, image_path)
         """
-        async with self.semaphore:
-            logger.info(f"Generating image for section {section_index + 1}: {heading}")
+        async with self._limiter:
+            logger.info("Generating image for section %d: %s", section_index + 1, heading)
             
             # Create final image prompt
             final_prompt = f"{image_prompt}. Style: {image_style}. Title: {heading}"
@@ -122,38 +172,29 @@ class ImageGenerator:
                 response = await self.api_client.generate_image(
                     prompt=final_prompt,
                     size="1024x1024",
-                    style="natural" if image_style.lower() == "natural" else "vivid"
+                    style=image_style_api
                 )
                 
-                # Extract the image URL from the response
-                if not response or 'data' not in response or not response['data']:
-                    raise ValueError("Invalid response format from DALL-E API")
-                    
-                image_url = response['data'][0].get('url')
-                if not image_url:
-                    raise ValueError("No image URL in DALL-E response")
+                image_bytes = response.get('image_bytes') if response else None
+                if not image_bytes:
+                    raise ValueError("No image data in DALL-E response")
                 
-                # Ensure output directory exists
-                os.makedirs(output_dir, exist_ok=True)
+                # Check the PNG header before anything is written, so invalid data never reaches disk
+                width, height = _png_dimensions(image_bytes[:24])
                 
-                # Download the generated image
-                async with httpx.AsyncClient() as client:
-                    img_response = await client.get(image_url)
-                    img_response.raise_for_status()
-                    
-                    # Save the image
-                    image_filename = f"section_{section_index + 1:02d}.png"
-                    image_path = os.path.join(output_dir, image_filename)
-                    
-                    # Process and save image
-                    img = Image.open(BytesIO(img_response.content))
-                    img.save(image_path, format="PNG")
-                    
-                logger.info(f"Successfully generated and saved image for section {section_index + 1} to {image_path}")
+                # Save the image (DALL-E returns PNG bytes, so write them as-is without decoding)
+                image_filename = f"section_{section_index + 1:02d}.png"
+                image_path = os.path.join(output_dir, image_filename)
+                
+                async with aiofiles.open(image_path, 'wb') as f:
+                    await f.write(image_bytes)
+                
+                logger.info("Successfully generated and saved %dx%d image for section %d to %s",
+                            width, height, section_index + 1, image_path)
                 return section_index, image_path
                 
             except Exception as e:
-                logger.error(f"Error generating image for section {section_index + 1}: {e}")
+                logger.error("Error generating image for section %d: %s", section_index + 1, e)
                 # Return placeholder in case of error
                 return section_index, ""
     
@@ -170,105 +211,129 @@ class ImageGenerator:
             sections: List of tuples (section_index, section_content)
             headings: List of section headings
             image_style: Style preference for images
-            output_dir: Directory to save generated images
+            output_dir: Directory to save generated images (must already exist)
             progress_callback: Optional callback function to report progress
             
         Returns:
             List of tuples (section_index, image_path) sorted by index
         """
-        logger.info(f"Starting generation of {len(sections)} images")
+        logger.info("Starting generation of %d images", len(sections))
         
-        # Create tasks for section summaries and image generation
-        summary_tasks = []
-        for section_index, content in sections:
-            if section_index < len(headings):
-                heading = headings[section_index]
-                task = asyncio.create_task(
-                    self.generate_section_summary(section_index, heading, content)
-                )
-                summary_tasks.append((section_index, heading, task))
+        total = len(sections)
+        # DALL-Eのstyleパラメータは全画像で共通なので一度だけ解決する
+        image_style_api = "natural" if image_style.lower() == "natural" else "vivid"
+        jobs = [
+            (section_index, headings[section_index], content)
+            for section_index, content in sections
+            if section_index < len(headings)
+        ]
         
-        # Wait for all summaries to complete
-        image_tasks = []
-        for section_index, heading, task in summary_tasks:
-            try:
-                image_prompt = await task
-                image_task = asyncio.create_task(
-                    self.generate_image(
-                        section_index, heading, image_prompt, image_style, output_dir
-                    )
-                )
-                image_tasks.append(image_task)
-                
-                # Report progress if callback provided
-                if progress_callback:
-                    summary_progress = (section_index + 1) / len(sections) * 0.5
-                    progress_callback(summary_progress, f"Generated image prompt {section_index + 1}/{len(sections)}")
-                    
-            except Exception as e:
-                logger.error(f"Error with summary for section {section_index + 1}: {e}")
+        # 要約が完成したものから（完了順に）画像生成タスクを起動する
+        # 実際の同時実行数はgenerate_image内のリミッターで制御する
+        # （実行中にset_max_concurrentで上限を上げても下げてもすぐに反映される）
+        # セクション番号の位置に直接格納する（最後にソートしない）
+        results: List[Optional[Tuple[int, str]]] = [None] * total
+        summaries_done = 0
+        images_done = 0
         
-        # Process image tasks with progress reporting
-        results = []
-        for future in asyncio.as_completed(image_tasks):
-            section_index, image_path = await future
-            results.append((section_index, image_path))
-            
-            # Report progress if callback provided
+        def report_progress(message: str):
             if progress_callback:
-                image_progress = 0.5 + (len(results) / len(sections) * 0.5)
-                progress_callback(image_progress, f"Generated image {len(results)}/{len(sections)}")
-                
-            logger.info(f"Completed {len(results)}/{len(image_tasks)} images")
+                progress_callback((summaries_done + images_done) / (2 * total), message)
         
-        # Sort results by section index
-        results.sort(key=lambda x: x[0])
-        return results
+        async def summarize(section_index: int, heading: str, content: str):
+            image_prompt = await self.generate_section_summary(section_index, heading, content)
+            return section_index, heading, image_prompt
         
-    def insert_images_into_markdown(self, 
-                                 combined_markdown: str, 
-                                 image_paths: List[Tuple[int, str]],
-                                 base_path: str = "") -> str:
+        async def generate(section_index: int, heading: str, image_prompt: str):
+            nonlocal images_done
+            results[section_index] = await self.generate_image(
+                section_index, heading, image_prompt, image_style, image_style_api, output_dir
+            )
+            images_done += 1
+            report_progress(f"Generated image {images_done}/{total}")
+            logger.info("Completed %d/%d images", images_done, len(jobs))
+        
+        async with asyncio.TaskGroup() as tg:
+            summary_tasks = [
+                tg.create_task(summarize(section_index, heading, content))
+                for section_index, heading, content in jobs
+            ]
+            # 先頭の要約が遅くても後続を待たせないよう、完了した順に画像生成へ渡す
+            for next_done in asyncio.as_completed(summary_tasks):
+                section_index, heading, image_prompt = await next_done
+                summaries_done += 1
+                report_progress(f"Generated image prompt {summaries_done}/{total}")
+                tg.create_task(generate(section_index, heading, image_prompt))
+        
+        # Drop the slots of sections without a heading (no image was generated for them)
+        return [result for result in results if result is not None]
+        
+    @staticmethod
+    def _image_refs(image_paths: List[Tuple[int, str]], base_path: str) -> Dict[int, str]:
         """
-        Insert images into the combined markdown document
+        Map section indices to the image references used in the markdown
         
         Args:
-            combined_markdown: Combined article content
             image_paths: List of tuples (section_index, image_path)
             base_path: Optional base path for image references
             
         Returns:
-            Markdown with images inserted
+            Dict of section_index -> image reference
         """
-        lines = combined_markdown.split("\n")
-        result_lines = []
-        current_section = 0
-        image_added = [False] * len(image_paths)
+        return {
+            section_index: f"{base_path}{os.path.basename(image_path)}" if base_path else os.path.basename(image_path)
+            for section_index, image_path in image_paths
+            if image_path
+        }
+    
+    async def write_markdown_with_images(self,
+                                      sections: List[Tuple[int, str]],
+                                      image_paths: List[Tuple[int, str]],
+                                      output_path: str,
+                                      base_path: str = "") -> str:
+        """
+        Write the combined article with images straight to a file
         
-        # Sort image paths by section index
-        sorted_image_paths = sorted(image_paths, key=lambda x: x[0])
+        Sections are written one at a time (with the image reference placed
+        after each section's main heading), so the full document is never
+        built in memory.
         
-        for line in lines:
-            result_lines.append(line)
+        Args:
+            sections: List of tuples (section_index, section_content)
+            image_paths: List of tuples (section_index, image_path)
+            output_path: Path of the markdown file to write
+            base_path: Optional base path for image references
             
-            # Look for main headings (# Title) to insert images
-            if line.startswith("# "):
-                if current_section < len(sorted_image_paths):
-                    section_index, image_path = sorted_image_paths[current_section]
+        Returns:
+            Path to the written markdown file
+        """
+        image_refs = self._image_refs(image_paths, base_path)
+        
+        async with aiofiles.open(output_path, 'w', encoding='utf-8') as f:
+            for section_index, content in sorted(sections, key=lambda x: x[0]):
+                section_content = content.replace(_END_MARKER, "")
+                image_ref = image_refs.get(section_index)
+                
+                # Find the section's main heading (# Title) to insert the image after it
+                if section_content.startswith("# "):
+                    heading_start = 0
+                else:
+                    heading_start = section_content.find("\n# ")
+                    if heading_start != -1:
+                        heading_start += 1
+                
+                if image_ref and heading_start != -1:
+                    heading_end = section_content.find("\n", heading_start)
+                    if heading_end == -1:
+                        heading_end = len(section_content)
+                    heading = section_content[heading_start:heading_end].lstrip('# ')
                     
-                    # If we have a valid image path for this section
-                    if image_path and not image_added[section_index]:
-                        # Get just the filename from the path
-                        image_filename = os.path.basename(image_path)
-                        image_ref = f"{base_path}{image_filename}" if base_path else image_filename
-                        
-                        # Insert image reference after the heading
-                        result_lines.append("")
-                        result_lines.append(f"![{line.lstrip('# ')}]({image_ref})")
-                        result_lines.append("")
-                        
-                        image_added[section_index] = True
+                    await f.write(section_content[:heading_end])
+                    await f.write(f"\n\n![{heading}]({image_ref})\n")
+                    await f.write(section_content[heading_end:])
+                else:
+                    await f.write(section_content)
                 
-                current_section += 1
+                await f.write("\n\n")
         
-        return "\n".join(result_lines)
+        return output_path
@@ -1,25 +1,139 @@
 """
 Outline Generator module for creating article outlines
 """
+import copy
 import json
+import asyncio
 import logging
-from typing import Dict, List, Any, Optional
+import textwrap
+import orjson
+from collections import OrderedDict
+from typing import Dict, List, Any, Optional, Tuple
 
 from .api_client import APIClient
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+__all__ = ["OutlineGenerator"]
+
 logger = logging.getLogger(__name__)
 
+# レスポンスからJSONを取り出すためのデコーダー（使い回す）
+_JSON_DECODER = json.JSONDecoder()
+
+# 毎回同一の内容を送るシステムプロンプト（可変の値はすべてユーザープロンプト側に置き、
+# 先頭一致のプロンプトキャッシュが効くようにする）
+_OUTLINE_SYSTEM_PROMPT = textwrap.dedent("""
+    You are an expert content strategist and SEO specialist. You will create a comprehensive outline for a very 
+    long-form article that will thoroughly cover all aspects of the provided topic.
+    
+    You will generate exactly the number of main headings and subheadings under each main heading requested by the user.
+    """).strip()
+
+# アウトライン生成依頼のユーザープロンプトのテンプレート（N: 大見出し数, S: 各大見出しの小見出し数）
+_USER_PROMPT_TMPL = textwrap.dedent("""
+    Create a comprehensive outline for an article about "{keyword}" targeting {target_audience}.
+    
+    The outline should include:
+    - Exactly {N} main headings (numbered 1-{N})
+    - Exactly {S} subheadings under each main heading
+    
+    You must generate exactly {N} main headings and exactly {S} subheadings under each main heading.
+    
+    Each heading should explore a different aspect of "{keyword}" and be designed to engage {target_audience}.
+    
+    Organize the topics in a logical progression, from introductory concepts to advanced applications.
+    
+    VERY IMPORTANT: Return your response in valid JSON format as follows:
+    {{
+        "outline": [
+            {{
+                "heading": "Main Heading 1",
+                "subheadings": ["Subheading 1.1", "Subheading 1.2", ...]
+            }},
+            ...and so on for all {N} headings
+        ]
+    }}
+    
+    Ensure all JSON is valid and properly escaped.
+    """).strip()
+
+def _extract_json_obj(text: str) -> Dict[str, Any]:
+    """
+    Extract the first JSON object from an LLM response in a single pass
+    
+    Args:
+        text: Response text (plain JSON, or JSON inside a ```json code block)
+        
+    Returns:
+        Parsed JSON object
+    """
+    # Narrow down to the inside of a ```json code block if there is one
+    _, fence, after_fence = text.partition('```json')
+    if fence:
+        text = after_fence.partition('```')[0]
+    
+    # Fast path: the candidate is a bare JSON document (the usual case)
+    try:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
+        pass
+    
+    # Otherwise decode the first object after any surrounding text
+    start = text.find('{')
+    if start == -1:
+        raise ValueError("Could not extract JSON from OpenAI response")
+    
+    obj, _ = _JSON_DECODER.raw_decode(text, start)
+    return obj
+
+def _default_outline(keyword: str,
+                     target_audience: str,
+                     num_main_headings: int,
+                     num_sub_headings: int) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Build the fallback outline used when outline generation fails
+    
+    Args:
+        keyword: Main article keyword/topic
+        target_audience: Description of target audience
+        num_main_headings: Number of main headings
+        num_sub_headings: Number of subheadings under each main heading
+        
+    Returns:
+        Dictionary containing main headings and subheadings
+    """
+    return {
+        "outline": [
+            {
+                "heading": f"Understanding {keyword}: A Comprehensive Introduction",
+                "subheadings": [f"What is {keyword}?", f"Why {keyword} Matters for {target_audience}"]
+            }
+        ] + [
+            {
+                "heading": f"Topic {i}: Important Aspect of {keyword}",
+                "subheadings": [f"Key Concept {i}.{j+1}" for j in range(num_sub_headings)]
+            }
+            for i in range(1, num_main_headings)
+        ]
+    }
+
 class OutlineGenerator:
-    def __init__(self, api_client: APIClient):
+    def __init__(self, api_client: APIClient, cache_size: int = 128):
         """
         Initialize outline generator
         
         Args:
             api_client: APIClient instance for making API calls
+            cache_size: Maximum number of generated outlines kept in the LRU cache
         """
         self.api_client = api_client
+        
+        # 同じ条件のアウトラインを再生成しないためのLRUキャッシュ（成功した結果のみ保持）
+        self._outline_cache: "OrderedDict[Tuple[str, str, int, int], Dict[str, Any]]" = OrderedDict()
+        self._outline_cache_size = cache_size
+        # 同じ条件の同時リクエストを1回のAPI呼び出しにまとめるためのキー単位のロックと、
+        # そのロックを使用中（保持中・待機中）の呼び出し数（0になった時点でロックを破棄）
+        self._outline_locks: Dict[Tuple[str, str, int, int], asyncio.Lock] = {}
+        self._outline_lock_users: Dict[Tuple[str, str, int, int], int] = {}
     
     async def generate_outline(self, 
                             keyword: str, 
@@ -38,134 +152,154 @@ class OutlineGenerator:
         Returns:
             Dictionary containing main headings and subheadings
         """
-        logger.info(f"Generating outline for keyword: {keyword}")
+        logger.info("Generating outline for keyword: %s", keyword)
         
-        # Create prompt for API
-        system_prompt = f"""
-        You are an expert content strategist and SEO specialist. You will create a comprehensive outline for a very 
-        long-form article that will thoroughly cover all aspects of the provided topic.
+        # 同じキーワード・対象読者・見出し数のアウトラインは生成済みのものを返す
+        cache_key = (keyword.strip().lower(), target_audience.strip().lower(), num_main_headings, num_sub_headings)
+        cached = self._outline_cache.get(cache_key)
+        if cached is not None:
+            self._outline_cache.move_to_end(cache_key)
+            logger.info("Reusing cached outline for keyword: %s", keyword)
+            return copy.deepcopy(cached)
         
-        You will generate exactly {num_main_headings} main headings and exactly {num_sub_headings} subheadings under each main heading.
+        lock = self._outline_locks.setdefault(cache_key, asyncio.Lock())
+        self._outline_lock_users[cache_key] = self._outline_lock_users.get(cache_key, 0) + 1
+        try:
+            async with lock:
+                # 待っている間に同じ条件の生成が終わっていればその結果を使う
+                cached = self._outline_cache.get(cache_key)
+                if cached is not None:
+                    self._outline_cache.move_to_end(cache_key)
+                    return copy.deepcopy(cached)
+                
+                try:
+                    outline_data = await self._request_outline(keyword, target_audience, num_main_headings, num_sub_headings)
+                except Exception as e:
+                    logger.error("Error generating outline: %s", e)
+                    # Return a default outline in case of error (not cached, so the next call retries)
+                    return _default_outline(keyword, target_audience, num_main_headings, num_sub_headings)
+                
+                self._outline_cache[cache_key] = outline_data
+                if len(self._outline_cache) > self._outline_cache_size:
+                    self._outline_cache.popitem(last=False)
+                return copy.deepcopy(outline_data)
+        finally:
+            # 最後の使用者だけがロックを破棄する（待機中の呼び出しがある間は同じロックを使い続ける）
+            self._outline_lock_users[cache_key] -= 1
+            if not self._outline_lock_users[cache_key]:
+                del self._outline_lock_users[cache_key]
+                del self._outline_locks[cache_key]
+    
+    async def _request_outline(self,
+                               keyword: str,
+                               target_audience: str,
+                               num_main_headings: int,
+                               num_sub_headings: int) -> Dict[str, List[Dict[str, Any]]]:
         """
+        Request an outline from the API and normalize it (raises on failure)
         
-        user_prompt = f"""
-        Create a comprehensive outline for an article about "{keyword}" targeting {target_audience}.
-        
-        The outline should include:
-        - Exactly {num_main_headings} main headings (numbered 1-{num_main_headings})
-        - Exactly {num_sub_headings} subheadings under each main heading
-        
-        Each heading should explore a different aspect of "{keyword}" and be designed to engage {target_audience}.
+        Args:
+            keyword: Main article keyword/topic
+            target_audience: Description of target audience
+            num_main_headings: Number of main headings
+            num_sub_headings: Number of subheadings under each main heading
+            
+        Returns:
+            Dictionary containing main headings and subheadings
+        """
+        # Create prompt for API
+        user_prompt = _USER_PROMPT_TMPL.format_map({
+            "keyword": keyword,
+            "target_audience": target_audience,
+            "N": num_main_headings,
+            "S": num_sub_headings
+        })
         
-        Organize the topics in a logical progression, from introductory concepts to advanced applications.
+        # Call OpenAI API to generate outline
+        response = await self.api_client.call_text_generation_api(
+            prompt=user_prompt,
+            system_prompt=_OUTLINE_SYSTEM_PROMPT,
+            max_tokens=8000,
+            model="gpt-4o"
+        )
         
-        VERY IMPORTANT: Return your response in valid JSON format as follows:
-        {{
-            "outline": [
-                {{
-                    "heading": "Main Heading 1",
-                    "subheadings": ["Subheading 1.1", "Subheading 1.2", ...]
-                }},
-                ...and so on for all {num_main_headings} headings
-            ]
-        }}
+        # Extract and parse JSON from response
+        choices = response.get('choices', [])
+        if not choices or not isinstance(choices, list):
+            raise ValueError("Invalid response format from OpenAI API")
+            
+        text_content = choices[0].get('message', {}).get('content', '{}')
         
-        Ensure all JSON is valid and properly escaped.
-        """
+        # Extract and parse the JSON object from the text content
+        outline_data = _extract_json_obj(text_content)
         
-        try:
-            # Call OpenAI API to generate outline
-            response = await self.api_client.call_text_generation_api(
-                prompt=user_prompt,
-                system_prompt=system_prompt,
-                max_tokens=8000,
-                model="gpt-4o"
-            )
-            
-            # Extract and parse JSON from response
-            choices = response.get('choices', [])
-            if not choices or not isinstance(choices, list):
-                raise ValueError("Invalid response format from OpenAI API")
-                
-            text_content = choices[0].get('message', {}).get('content', '{}')
-            
-            # Try to extract JSON from the text content
-            try:
-                # First, try to parse the entire response as JSON
-                outline_data = json.loads(text_content)
-            except json.JSONDecodeError:
-                # If that fails, try to extract JSON from markdown code blocks
-                import re
-                json_match = re.search(r'```json\n(.*?)\n```', text_content, re.DOTALL)
-                if json_match:
-                    json_str = json_match.group(1)
-                    outline_data = json.loads(json_str)
-                else:
-                    # Last resort, try to find any JSON-like structure
-                    json_match = re.search(r'({.*})', text_content, re.DOTALL)
-                    if json_match:
-                        json_str = json_match.group(1)
-                        outline_data = json.loads(json_str)
-                    else:
-                        raise ValueError("Could not extract JSON from OpenAI response")
-            
-            # Validate the outline structure
-            if "outline" not in outline_data or not isinstance(outline_data["outline"], list):
-                raise ValueError("Invalid outline structure in response")
-                
-            # Ensure exactly num_main_headings main headings
-            if len(outline_data["outline"]) != num_main_headings:
-                logger.warning(f"Expected {num_main_headings} headings, but got {len(outline_data['outline'])}. Adjusting...")
-                
-                # If fewer than expected, pad with defaults
-                if len(outline_data["outline"]) < num_main_headings:
-                    for i in range(len(outline_data["outline"]), num_main_headings):
-                        default_subheadings = [f"Aspect {j+1} of Topic {i+1}" for j in range(num_sub_headings)]
-                        outline_data["outline"].append({
-                            "heading": f"Additional Topic {i+1} on {keyword}",
-                            "subheadings": default_subheadings
-                        })
-                # If more than expected, truncate
-                elif len(outline_data["outline"]) > num_main_headings:
-                    outline_data["outline"] = outline_data["outline"][:num_main_headings]
+        # Validate the outline structure
+        sections = outline_data.get("outline") if isinstance(outline_data, dict) else None
+        if not isinstance(sections, list):
+            raise ValueError("Invalid outline structure in response")
             
-            # Ensure each heading has exactly num_sub_headings subheadings
-            for i, section in enumerate(outline_data["outline"]):
-                if "subheadings" not in section or not isinstance(section["subheadings"], list):
-                    # 何も設定されていない場合はデフォルトの小見出しを追加
-                    default_subheadings = [f"Aspect {j+1} of {section['heading']}" for j in range(num_sub_headings)]
-                    outline_data["outline"][i]["subheadings"] = default_subheadings
-                elif len(section["subheadings"]) != num_sub_headings:
-                    if len(section["subheadings"]) < num_sub_headings:
-                        # 少ない場合は追加
-                        heading = section["heading"]
-                        while len(section["subheadings"]) < num_sub_headings:
-                            section["subheadings"].append(f"Additional Aspect {len(section['subheadings'])+1} of {heading}")
-                    elif len(section["subheadings"]) > num_sub_headings:
-                        # 多い場合は切り詰め
-                        section["subheadings"] = section["subheadings"][:num_sub_headings]
+        # Ensure exactly num_main_headings main headings
+        current = len(sections)
+        if current != num_main_headings:
+            logger.warning("Expected %d headings, but got %d. Adjusting...", num_main_headings, current)
             
-            logger.info(f"Successfully generated outline with {len(outline_data['outline'])} main headings")
-            return outline_data
-            
-        except Exception as e:
-            logger.error(f"Error generating outline: {e}")
-            # Return a default outline in case of error
-            default_outline = {
-                "outline": [
+            # If fewer than expected, pad with defaults
+            if current < num_main_headings:
+                sections.extend([
                     {
-                        "heading": f"Understanding {keyword}: A Comprehensive Introduction",
-                        "subheadings": [f"What is {keyword}?", f"Why {keyword} Matters for {target_audience}"]
+                        "heading": f"Additional Topic {i+1} on {keyword}",
+                        "subheadings": [f"Aspect {j+1} of Topic {i+1}" for j in range(num_sub_headings)]
                     }
-                ]
-            }
+                    for i in range(current, num_main_headings)
+                ])
+            # If more than expected, truncate
+            elif current > num_main_headings:
+                del sections[num_main_headings:]
+        
+        # Ensure each heading has exactly num_sub_headings subheadings
+        # (bind each section's values to locals once and mutate the lists in place)
+        for section in sections:
+            subheadings = section.get("subheadings")
+            if not isinstance(subheadings, list):
+                # 何も設定されていない場合はデフォルトの小見出しを追加
+                heading = section["heading"]
+                section["subheadings"] = [f"Aspect {j+1} of {heading}" for j in range(num_sub_headings)]
+                continue
             
-            # Generate remaining default headings
-            for i in range(1, num_main_headings):
-                default_subheadings = [f"Key Concept {i}.{j+1}" for j in range(num_sub_headings)]
-                default_outline["outline"].append({
-                    "heading": f"Topic {i}: Important Aspect of {keyword}",
-                    "subheadings": default_subheadings
-                })
-                
-            return default_outline
+            current_sub = len(subheadings)
+            if current_sub < num_sub_headings:
+                # 少ない場合は追加
+                heading = section["heading"]
+                subheadings.extend(
+                    f"Additional Aspect {k+1} of {heading}" for k in range(current_sub, num_sub_headings)
+                )
+            elif current_sub > num_sub_headings:
+                # 多い場合は切り詰め
+                del subheadings[num_sub_headings:]
+        
+        logger.info("Successfully generated outline with %d main headings", len(sections))
+        return outline_data
+    
+    async def generate_outlines_batch(self,
+                                   jobs: List[Tuple[str, str, str]],
+                                   num_main_headings: int = 30,
+                                   num_sub_headings: int = 2) -> List[Dict[str, List[Dict[str, Any]]]]:
+        """
+        Generate outlines for several keywords concurrently
+        
+        Each outline is still its own request (a combined prompt would have to fit
+        every outline into one 8k-token response); the requests share the static
+        system prompt and run in parallel over the shared HTTP/2 connection.
+        
+        Args:
+            jobs: List of tuples (keyword, target_audience, image_style)
+            num_main_headings: Number of main headings per outline
+            num_sub_headings: Number of subheadings under each main heading
+            
+        Returns:
+            List of outlines in the same order as jobs
+        """
+        return list(await asyncio.gather(*[
+            self.generate_outline(keyword, target_audience, image_style, num_main_headings, num_sub_headings)
+            for keyword, target_audience, image_style in jobs
+        ]))
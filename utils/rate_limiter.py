@@ -0,0 +1,101 @@
+"""
+Rate limiter module for client-side throttling of API requests
+"""
+import time
+import asyncio
+
+
+class TokenBucket:
+    def __init__(self, capacity: float, refill_rate: float):
+        """
+        Initialize token bucket
+
+        Args:
+            capacity: Maximum number of tokens the bucket can hold
+            refill_rate: Number of tokens added per second
+        """
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    def per_minute(cls, limit: float) -> "TokenBucket":
+        """
+        Create a bucket allowing `limit` tokens per minute
+
+        Args:
+            limit: Tokens allowed per minute (e.g. RPM or TPM)
+
+        Returns:
+            TokenBucket instance
+        """
+        return cls(capacity=limit, refill_rate=limit / 60.0)
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated_at
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.refill_rate)
+        self._updated_at = now
+
+    async def acquire(self, amount: float = 1):
+        """
+        Wait until `amount` tokens are available and consume them
+
+        Args:
+            amount: Number of tokens to consume (clamped to capacity)
+        """
+        amount = min(amount, self.capacity)
+
+        # ロックを保持したまま待機し、先着順にトークンを払い出す
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return
+                await asyncio.sleep((amount - self._tokens) / self.refill_rate)
+
+
+class ConcurrencyLimiter:
+    def __init__(self, limit: int):
+        """
+        Initialize concurrency limiter
+
+        Unlike asyncio.Semaphore, the limit can be changed while tasks are
+        waiting; raising it wakes up waiters immediately.
+
+        Args:
+            limit: Maximum number of tasks allowed inside at the same time
+        """
+        self.limit = limit
+        self._inflight = 0
+        self._cond = asyncio.Condition()
+
+    async def __aenter__(self) -> "ConcurrencyLimiter":
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._inflight < self.limit)
+            self._inflight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # 枠はロックを待たずに返す（ロック待ちの間にキャンセルされても枠が失われないようにする）
+        # 待機中のタスクへの通知も、キャンセルで取りこぼさないようshieldで保護する
+        self._inflight -= 1
+        await asyncio.shield(self._notify_waiter())
+
+    async def _notify_waiter(self):
+        async with self._cond:
+            self._cond.notify(1)
+
+    async def set_limit(self, limit: int):
+        """
+        Change the concurrency limit
+
+        Args:
+            limit: New maximum number of concurrent tasks
+        """
+        async with self._cond:
+            self.limit = limit
+            self._cond.notify_all()